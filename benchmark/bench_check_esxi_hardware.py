@@ -0,0 +1,364 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+#
+# Benchmark of check_esxi_hardware.py against a local pywbem_mock CIM server
+#
+# Licence : GNU General Public Licence (GPL) http://www.gnu.org/
+#
+# A synthetic ESXi-like host (all classes of ClassesToCheck, with a configurable number
+# of numeric sensors, storage extents and SEL records) is compiled from MOF into a
+# pywbem_mock.FakedWBEMConnection once. Every check then gets a copy of it as connection,
+# optionally with an artificial latency per CIM request, and is run as a library call
+# (check_options/HostCheck), so interpreter startup is not part of the measurement.
+#
+# For each scenario (a set of check_esxi_hardware.py options) the benchmark reports the
+# median wall time, CPU time and CIM requests per check, plus the peak memory of one check
+# measured in a separate run with tracemalloc. The mock server runs in the same process and
+# is slow (it copies its whole repository on every request), so the time spent in it is
+# reported separately and left out of the plugin CPU time.
+#
+# With --hosts it checks that many hosts with --workers at a time, once with threads as
+# --hostlist does and once with AsyncHostChecker as --hostlist --async does, and fails if a check
+# is not completed, e.g. because hosts waiting for a worker ran into --timeout.
+#
+# With --startup it measures the start of the plugin in a new interpreter instead: importing
+# it and --help, compared to a bare interpreter. --startup-budget makes it fail if importing
+# the plugin takes longer than that or if --help imports pywbem.
+#
+# example: ./bench_check_esxi_hardware.py --sensors 400 --extents 48 --latency 20
+#          ./bench_check_esxi_hardware.py -s "default=" -s "parallel=--parallel 4"
+#          ./bench_check_esxi_hardware.py --hosts 12 --workers 2 --timeout 3 --latency 20
+#          ./bench_check_esxi_hardware.py --startup --startup-budget 25
+#
+# Pre-req : pywbem (pywbem_mock is part of it)
+
+import os
+import sys
+import asyncio
+import time
+import shutil
+import subprocess
+import tempfile
+import threading
+import tracemalloc
+from optparse import OptionParser
+
+PluginDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, PluginDir)
+
+import pywbem_mock
+import check_esxi_hardware as esxi
+
+# scenarios compared by default, name and options as given on the command line
+DefaultScenarios = [
+  ('default', ''),
+  ('no-projection', '--no-projection'),
+  ('parallel', '--parallel 4'),
+  ('pull', '--pull 100'),
+  ('fast-health', '--fast-health'),
+  ('cached', '--cache-dir {cache} --tiered'),
+  ('sel', '--cache-dir {cache} --sel'),
+]
+
+# ----------------------------------------------------------------------
+
+QualifierMof = """
+Qualifier Key : boolean = false, Scope(property, reference), Flavor(DisableOverride, ToSubclass);
+Qualifier Description : string = null, Scope(any), Flavor(EnableOverride, ToSubclass, Translatable);
+Qualifier Association : boolean = false, Scope(association), Flavor(DisableOverride, ToSubclass);
+"""
+
+# properties of every class, Caption and Description are not used by the check
+# and only make the instances as large as on a real host
+CommonMof = """
+   [Key] string CreationClassName;
+   [Key] string DeviceID;
+   string ElementName;
+   string Name;
+   string Caption;
+   string Description;
+   uint16 OperationalStatus[];
+   uint16 HealthState;
+"""
+
+ClassMof = {
+  'OMC_SMASHFirmwareIdentity': "string VersionString; datetime ReleaseDate;",
+  'CIM_Chassis': "string Manufacturer; string SerialNumber; string Model;",
+  'CIM_Card': "string Manufacturer; string SerialNumber; string Model;",
+  'CIM_ComputerSystem': "string Manufacturer; string SerialNumber; string Model;",
+  'CIM_NumericSensor': "uint16 SensorType; uint16 BaseUnits; sint32 UnitModifier; sint32 CurrentReading; "
+    "sint32 LowerThresholdNonCritical; sint32 UpperThresholdNonCritical; "
+    "sint32 LowerThresholdCritical; sint32 UpperThresholdCritical;",
+  'CIM_Processor': "uint16 Family; uint32 CurrentClockSpeed;",
+}
+
+# sensor type and base units of the numeric sensors, in turn
+SensorKinds = [(2, 2), (3, 5), (4, 7), (5, 19)]
+
+def host_mof(sensors, extents, records):
+  # MOF of the classes and instances of a synthetic host
+  mof = [QualifierMof]
+  for classe in esxi.ClassesToCheck:
+    mof.append("class %s {%s %s};" % (classe, CommonMof, ClassMof.get(classe, '')))
+  mof.append("class CIM_LogRecord { [Key] string LogCreationClassName; [Key] string LogName; "
+    "[Key] string CreationClassName; [Key] string RecordID; string ElementName; datetime MessageTimestamp; "
+    "uint16 PerceivedSeverity; string Description; string RecordData; };")
+  mof.append("[Association] class CIM_LogManagesRecord { [Key] CIM_RecordLog REF Log; [Key] CIM_LogRecord REF Record; };")
+
+  def instance(classe, i, name, extra=''):
+    mof.append('instance of %s { CreationClassName="%s"; DeviceID="%d"; ElementName="%s"; Name="%s"; '
+      'Caption="%s"; Description="%s of the synthetic host"; OperationalStatus={2}; HealthState=5; %s };'
+      % (classe, classe, i, name, name, name, name, extra))
+
+  instance('OMC_SMASHFirmwareIdentity', 0, 'System BIOS', 'VersionString="2.1.3"; ReleaseDate="20200101000000.000000+000";')
+  instance('CIM_Chassis', 0, 'Chassis', 'Manufacturer="Dell Inc."; SerialNumber="ABC1234"; Model="PowerEdge R640";')
+  instance('CIM_Card', 0, 'System Board 1', 'Manufacturer="Dell Inc."; SerialNumber="CN1234"; Model="0ABCDE";')
+  instance('CIM_ComputerSystem', 0, 'System')
+  for i in range(sensors):
+    sensorType, units = SensorKinds[i % len(SensorKinds)]
+    instance('CIM_NumericSensor', i, 'Sensor %d' % i, 'SensorType=%d; BaseUnits=%d; UnitModifier=-2; '
+      'CurrentReading=%d; LowerThresholdNonCritical=100; UpperThresholdNonCritical=9000; '
+      'LowerThresholdCritical=50; UpperThresholdCritical=9500;' % (sensorType, units, 1000 + i))
+  for i in range(16):
+    instance('CIM_Memory', i, 'DIMM %d' % i)
+  for i in range(2):
+    instance('CIM_Processor', i, 'CPU%d' % (i + 1), 'Family=2; CurrentClockSpeed=2400;')
+  mof.append('instance of CIM_RecordLog as $sel { CreationClassName="CIM_RecordLog"; DeviceID="0"; '
+    'ElementName="IPMI SEL"; Name="IPMI SEL"; OperationalStatus={2}; HealthState=5; };')
+  for i in range(records):
+    mof.append('instance of CIM_LogRecord as $r%d { LogCreationClassName="CIM_RecordLog"; LogName="IPMI SEL"; '
+      'CreationClassName="CIM_LogRecord"; RecordID="%d"; MessageTimestamp="2024%02d%02d000000.000000+000"; '
+      'PerceivedSeverity=2; Description="Event %d"; };' % (i, i, 1 + i % 12, 1 + i % 28, i))
+    mof.append('instance of CIM_LogManagesRecord { Log = $sel; Record = $r%d; };' % i)
+  for i in range(8):
+    instance('OMC_DiscreteSensor', i, 'Discrete Sensor %d' % i)
+  for i in range(6):
+    instance('OMC_Fan', i, 'Fan %d' % (i + 1))
+  for i in range(2):
+    instance('OMC_PowerSupply', i, 'PSU %d' % (i + 1))
+  for i in range(extents):
+    instance('VMware_StorageExtent', i, 'Disk %d on Controller 0' % i)
+  instance('VMware_Controller', 0, 'Controller 0')
+  for i in range(2):
+    instance('VMware_StorageVolume', i, 'Volume %d' % i)
+  instance('VMware_Battery', 0, 'Battery on Controller 0')
+  for i in range(8):
+    instance('VMware_SASSATAPort', i, 'Port %d' % i)
+  return "\n".join(mof)
+
+# ----------------------------------------------------------------------
+
+class FakeHost:
+  # Hands out copies of one compiled mock host as connections and counts the CIM requests
+
+  def __init__(self, sensors, extents, records, latency):
+    self.template = pywbem_mock.FakedWBEMConnection(default_namespace=esxi.NS)
+    self.template.compile_mof_string(host_mof(sensors, extents, records), namespace=esxi.NS)
+    self.latency = latency
+    self.requests = 0
+    self.server_time = 0
+    self.lock = threading.Lock()
+
+  def connection(self, opts):
+    conn = self.template.copy()
+    if opts.pull > 0:
+      conn._use_enum_inst_pull_operations = None
+    request = conn._imethodcall
+
+    def counted(*args, **kwargs):
+      if self.latency:
+        time.sleep(self.latency)
+      # CPU time of this thread, so concurrent requests aren't counted with each other's time
+      start = time.thread_time()
+      try:
+        return request(*args, **kwargs)
+      finally:
+        with self.lock:
+          self.requests += 1
+          self.server_time += time.thread_time() - start
+
+    conn._imethodcall = counted
+    return conn
+
+# ----------------------------------------------------------------------
+
+def scenario_options(args, cache):
+  (opts, rest) = esxi.option_parser().parse_args(args.format(cache=cache).split())
+  # same as in getopts(), but the benchmark runs without signal.alarm
+  opts.user = 'root'
+  opts.password = 'password'
+  opts.vendor = 'auto'
+  opts.perfdata = True
+  opts.conn_timeout = None
+  return opts
+
+def run_check(args, cache):
+  opts = scenario_options(args, cache)
+  esxi.set_host(opts, 'esxi.benchmark')
+  check = esxi.HostCheck(opts).run()
+  if check.failure:
+    raise RuntimeError(check.failure)
+  return check.output()
+
+def run_scenario(host, name, args, runs):
+  # Returns the median wall time, CPU time, mock server time and requests of one check,
+  # and the peak memory
+  cache = tempfile.mkdtemp(prefix='bench_esxi_')
+  try:
+    # one run to warm up (and to fill the cache of the caching scenarios)
+    run_check(args, cache)
+    walls, cpus, servers, requests = [], [], [], []
+    for i in range(runs):
+      host.requests = 0
+      host.server_time = 0
+      wall, cpu = time.perf_counter(), time.process_time()
+      run_check(args, cache)
+      walls.append(time.perf_counter() - wall)
+      cpus.append(time.process_time() - cpu)
+      servers.append(host.server_time)
+      requests.append(host.requests)
+    tracemalloc.start()
+    run_check(args, cache)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+  finally:
+    shutil.rmtree(cache)
+  return median(walls), median(cpus), median(servers), median(requests), peak
+
+def median(values):
+  return sorted(values)[len(values) // 2]
+
+# ----------------------------------------------------------------------
+
+def run_hosts(count, workers, timeout):
+  # Returns the exit code, 1 if a check of a host was not completed
+  import concurrent.futures
+
+  def host_options(i):
+    opts = scenario_options('--timeout %d' % timeout if timeout else '', '')
+    esxi.set_host(opts, 'esxi%d.benchmark' % i)
+    # as in run_hostlist, the timeout applies to each CIM request instead of signal.alarm
+    if timeout:
+      opts.conn_timeout = timeout
+    return opts
+
+  def threads():
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+      return list(executor.map(lambda opts: esxi.HostCheck(opts).run(), [host_options(i) for i in range(count)]))
+
+  def async_checker():
+    checker = esxi.AsyncHostChecker(workers, 1)
+    async def check_all():
+      return await asyncio.gather(*(checker.run_check(host_options(i)) for i in range(count)))
+    checks = asyncio.run(check_all())
+    checker.executor.shutdown()
+    return checks
+
+  print("%d hosts, %d workers, timeout %ds" % (count, workers, timeout))
+  print("%-16s %10s %12s" % ('', 'wall ms', 'incomplete'))
+  incomplete = 0
+  for name, run in [('threads', threads), ('async', async_checker)]:
+    start = time.perf_counter()
+    checks = run()
+    wall = time.perf_counter() - start
+    failed = [check for check in checks if check.failure or check.timed_out]
+    print("%-16s %10.1f %12d" % (name, wall * 1000, len(failed)))
+    for check in failed[:3]:
+      print("  %s: %s" % (check.opts.hostname, check.output()))
+    incomplete += len(failed)
+  return 1 if incomplete else 0
+
+# ----------------------------------------------------------------------
+
+def startup_time(args, runs):
+  # median wall time of running the interpreter with args, in the plugin directory
+  times = []
+  for i in range(runs):
+    start = time.perf_counter()
+    subprocess.call([sys.executable] + args, cwd=PluginDir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    times.append(time.perf_counter() - start)
+  return median(times)
+
+def run_startup(runs, budget):
+  # Returns the exit code, 1 if the plugin is over the budget
+  plugin = os.path.join(PluginDir, 'check_esxi_hardware.py')
+  bare = startup_time(['-c', 'pass'], runs)
+  print("startup, median of %d runs" % runs)
+  print("%-24s %10s %10s" % ('', 'wall ms', 'added ms'))
+  print("%-24s %10.1f" % ('python', bare * 1000))
+  added = {}
+  for name, args in [('import plugin', ['-c', 'import check_esxi_hardware']), ('plugin --help', [plugin, '--help']),
+      ('import pywbem', ['-c', 'import pywbem'])]:
+    wall = startup_time(args, runs)
+    added[name] = wall - bare
+    print("%-24s %10.1f %10.1f" % (name, wall * 1000, added[name] * 1000))
+
+  importtime = subprocess.run([sys.executable, '-X', 'importtime', plugin, '--help'], cwd=PluginDir,
+      stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True).stderr
+  pywbem_imported = any(line.rstrip().endswith('| pywbem') for line in importtime.splitlines())
+  print("--help imports pywbem: %s" % ('yes' if pywbem_imported else 'no'))
+  if budget and (pywbem_imported or added['import plugin'] * 1000 > budget):
+    print("over the startup budget of %gms" % budget)
+    return 1
+  return 0
+
+# ----------------------------------------------------------------------
+
+def getopts():
+  usage = "usage: %prog [--sensors N --extents N --records N --latency MS --runs N -s name=options]"
+  parser = OptionParser(usage=usage)
+  parser.add_option("--sensors", action="store", type="int", dest="sensors", default=100, \
+      help="numeric sensors of the host (default = 100)", metavar="N")
+  parser.add_option("--extents", action="store", type="int", dest="extents", default=24, \
+      help="storage extents of the host (default = 24)", metavar="N")
+  parser.add_option("--records", action="store", type="int", dest="records", default=50, \
+      help="records in the SEL of the host (default = 50)", metavar="N")
+  parser.add_option("--latency", action="store", type="float", dest="latency", default=0, \
+      help="milliseconds added to each CIM request (default = 0)", metavar="MS")
+  parser.add_option("--runs", action="store", type="int", dest="runs", default=5, \
+      help="measured checks per scenario (default = 5)", metavar="N")
+  parser.add_option("-s", "--scenario", action="append", dest="scenarios", default=[], \
+      help="scenario to run instead of the default ones, given as name=options where options are " \
+      "check_esxi_hardware.py options and {cache} stands for a temporary cache directory. " \
+      "May be given several times", metavar="NAME=OPTIONS")
+  parser.add_option("--hosts", action="store", type="int", dest="hosts", default=0, \
+      help="check N hosts with threads and with AsyncHostChecker instead of the scenarios, and fail " \
+      "if a check is not completed", metavar="N")
+  parser.add_option("--workers", action="store", type="int", dest="workers", default=2, \
+      help="with --hosts, hosts (threads) or CIM requests (async) at a time (default = 2)", metavar="N")
+  parser.add_option("--timeout", action="store", type="int", dest="timeout", default=0, \
+      help="with --hosts, --timeout of each check (default = 0, none)", metavar="SECONDS")
+  parser.add_option("--startup", action="store_true", dest="startup", default=False, \
+      help="measure the startup of the plugin in a new interpreter instead of checks")
+  parser.add_option("--startup-budget", action="store", type="float", dest="startup_budget", default=0, \
+      help="with --startup, fail if importing the plugin adds more than MS to the interpreter start, " \
+      "or if --help imports pywbem (default = 0, no budget)", metavar="MS")
+  (options, args) = parser.parse_args()
+  options.runs = max(1, options.runs)
+  return options
+
+def main():
+  options = getopts()
+  if options.startup:
+    sys.exit(run_startup(max(options.runs, 10), options.startup_budget))
+  scenarios = DefaultScenarios
+  if options.scenarios:
+    scenarios = [tuple(s.split('=', 1)) if '=' in s else (s, '') for s in options.scenarios]
+
+  host = FakeHost(options.sensors, options.extents, options.records, options.latency / 1000.0)
+  esxi.new_connection = host.connection
+  if options.hosts:
+    sys.exit(run_hosts(options.hosts, max(1, options.workers), options.timeout))
+
+  print("host: %d sensors, %d storage extents, %d SEL records, %gms latency per request, median of %d runs" \
+      % (options.sensors, options.extents, options.records, options.latency, options.runs))
+  print("%-16s %10s %10s %10s %10s %9s %10s  %s" % ('scenario', 'wall ms', 'cpu ms', 'mock ms', 'plugin ms',
+      'requests', 'peak KiB', 'options'))
+  for name, args in scenarios:
+    wall, cpu, server, requests, peak = run_scenario(host, name, args, options.runs)
+    print("%-16s %10.1f %10.1f %10.1f %10.1f %9d %10d  %s" % (name, wall * 1000, cpu * 1000, server * 1000,
+        max(0, cpu - server) * 1000, requests, peak / 1024, args))
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+  main()
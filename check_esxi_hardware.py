@@ -301,22 +301,34 @@
 #@ Date   : 20250221
 #@ Author : Claudio Kuenzler
 #@ Reason : Update to newer pywbem exception call, catch HTTPError
-#@ Attn   : Requires 'packaging' Python module from now on!
 #@---------------------------------------------------
 #@ Date   : 20250716
 #@ Author : Peter Newman
 #@ Reason : Adjust exit code -1 to 3 (Nagios UNKNOWN)
 #@---------------------------------------------------
+#@ Date   : 20261017
+#@ Author : Various contributors
+#@ Reason : Fetch classes in parallel (--parallel), with pull operations (--pull)
+#@          or only the unhealthy elements (--fast-health)
+#@          Check many hosts at once (--hostlist, --async), as daemon (--daemon)
+#@          or as Prometheus exporter (--exporter)
+#@          Cache host capabilities, vendor and slow classes (--cache-dir, --tiered)
+#@          Alert on new SEL records only (--sel), keep a sensor history (--history)
+#@          Partial results on --timeout, retries, per-host limits and circuit breaker
+#@          Passive results (--command-file, --spool-dir), --format ndjson/influx
+#@          check_host() library API, benchmark, --timings and --profile
+#@ Attn   : The 'packaging' Python module is no longer required
+#@---------------------------------------------------
 
+import os
 import sys
 import time
-import pywbem
-import re
-import json
+import threading
+import contextlib
 from optparse import OptionParser,OptionGroup
-from packaging.version import Version
+# pywbem, json and re are only imported where needed, see import_pywbem()
 
-version = '20250716'
+version = '20261017'
 
 NS = 'root/cimv2'
 hosturl = ''
@@ -341,6 +353,32 @@ ClassesToCheck = [
   'VMware_SASSATAPort'
 ]
 
+# properties requested per class, everything else is left on the CIM server
+# (these are all the properties the checks below read)
+ClassProperties = {
+  'OMC_SMASHFirmwareIdentity': ['Name', 'VersionString', 'ReleaseDate'],
+  'CIM_Chassis': ['Manufacturer', 'SerialNumber', 'Model'],
+  'CIM_Card': ['Manufacturer', 'SerialNumber', 'Model'],
+  'CIM_ComputerSystem': ['Manufacturer', 'SerialNumber', 'Model'],
+  'CIM_NumericSensor': ['SensorType', 'BaseUnits', 'UnitModifier', 'CurrentReading',
+                        'LowerThresholdNonCritical', 'UpperThresholdNonCritical',
+                        'LowerThresholdCritical', 'UpperThresholdCritical'],
+  'CIM_Processor': ['Family', 'CurrentClockSpeed']
+}
+
+# seconds of the --timeout kept for each class still to fetch, a slow class may use the rest
+ClassTimeBudget = 1
+
+# classes always fetched completely with --fast-health, they provide the server information
+FastHealthFullClasses = ['OMC_SMASHFirmwareIdentity', 'CIM_Chassis', 'CIM_ComputerSystem']
+
+# classes which name the ESXi version and build, for the capability cache (--cache-dir)
+BuildClasses = ['VMware_SoftwareIdentity', 'CIM_Product']
+BuildProperties = ['ElementName', 'Name', 'VersionString', 'Version']
+
+# properties requested for every class
+CommonProperties = ['ElementName', 'OperationalStatus', 'HealthState']
+
 sensor_Type = {
   0:'unknown',
   1:'Other',
@@ -363,8 +401,17 @@ sensor_Type = {
   65535:'Vendor Reserved'
 }
 
-data = []
-xdata = {}
+# BaseUnits of numeric sensors, for the unit label of the exporter
+sensor_Units = {
+  2:'celsius',
+  3:'fahrenheit',
+  4:'kelvin',
+  5:'volts',
+  6:'amperes',
+  7:'watts',
+  19:'rpm',
+  65:'percent'
+}
 
 perf_Prefix = {
   1:'Pow',
@@ -376,52 +423,26 @@ perf_Prefix = {
 }
 
 
-# parameters
-
-# host name
-hostname=''
-
-# cim port
-cimport=''
-
-# user
-user=''
-
-# password
-password=''
-
-# vendor - possible values are 'unknown', 'auto', 'dell', 'hp', 'ibm', 'intel'
-vendor='unknown'
+# parameters are parsed into an options object by getopts(), only verbose is global
 
 # verbose
 verbose=False
 
-# output json
-format='string'
-pretty=False
-
-# Produce performance data output for nagios
-perfdata=False
-
-# timeout
-timeout = 0
-
-# elements to ignore (full SEL, broken BIOS, etc)
-ignore_list=[]
-regex_ignore_list=[]
-regex=False
+# refresh intervals in seconds of rarely changing classes, used with --tiered
+# the last result of these classes is reused from --cache-dir until it is older than that
+ClassRefresh = {
+  'OMC_SMASHFirmwareIdentity': 3600,
+  'CIM_Card': 3600,
+  'CIM_Memory': 3600,
+  'CIM_Processor': 3600
+}
 
-# urlise model and tag numbers (currently only Dell supported, but the code does the right thing for other vendors)
-urlise_country=''
+# CIM status codes telling that a query can't be run at all
+CIM_ERR_NOT_SUPPORTED = 7
+CIM_ERR_QUERY_LANGUAGE_NOT_SUPPORTED = 14
 
-# collect perfdata for each category
-get_power   = True
-get_volts   = True
-get_current = True
-get_temp    = True
-get_fan     = True
-get_lcd     = True
-get_intrusion = True
+# CIM status codes telling that a class doesn't exist on the host
+CIM_ERR_CLASS_MISSING = [5, 6, CIM_ERR_NOT_SUPPORTED]   # invalid class, not found, not supported
 
 # define exit codes
 ExitOK = 0
@@ -429,8 +450,31 @@ ExitWarning = 1
 ExitCritical = 2
 ExitUnknown = 3
 
-# Special handling for blade servers
-isblade = "no"
+# elements ignored with --no-lcd
+lcd_elements = [
+  "System Board 1 LCD Cable Pres 0: Connected",
+  "System Board 1 VGA Cable Pres 0: Connected",
+  "Front Panel Board 1 FP LCD Cable 0: Connected",
+  "Front Panel Board 1 FP LCD Cable 0: Config Error"
+]
+
+# elements always ignored for Dell, Intel, IBM and unknown vendors
+dell_elements = [
+  "System Board 1 Riser Config Err 0: Connected",
+  "Add-in Card 4 PEM Presence 0: Connected"
+]
+
+# elements ignored with --no-intrusion
+intrusion_elements = [
+  "System Chassis 1 Chassis Intru: General Chassis intrusion",
+  "System Chassis 1 Chassis Intru: Drive Bay intrusion",
+  "System Chassis 1 Chassis Intru: I/O Card area intrusion",
+  "System Chassis 1 Chassis Intru: Processor area intrusion",
+  "System Chassis 1 Chassis Intru: System unplugged from LAN",
+  "System Chassis 1 Chassis Intru: Unauthorized dock",
+  "System Chassis 1 Chassis Intru: FAN area intrusion",
+  "System Chassis 1 Chassis Intru: Unknown"
+]
 
 def dell_country(country):
   if country == 'at':  # Austria
@@ -496,6 +540,7 @@ def urlised_server_info(vendor, country, server_info):
     # Dell support URLs (idea and tables borrowed from check_openmanage)
     du = 'http://www.dell.com/support/home/' + dell_country(country) + '04/product-support/product/poweredge-'
     if (server_info is not None) :
+      import re
       p=re.match('(.*)PowerEdge (.*) (.*)',server_info)
       if (p is not None) :
         md=p.group(2)
@@ -545,20 +590,641 @@ def verboseoutput(message) :
 
 # ----------------------------------------------------------------------
 
-def xdataprint():
-  if format == 'json' and not pretty:
-    print(json.dumps(xdata, sort_keys=True))
-  if format == 'json' and pretty:
-    print(json.dumps(xdata, sort_keys=True, indent=4))
+def xdataprint(opts, xdata):
+  import json
+  if opts.pretty:
+    return json.dumps(xdata, sort_keys=True, indent=4)
+  return json.dumps(xdata, sort_keys=True)
 
 # ----------------------------------------------------------------------
 
-def getopts() :
-  global hosturl,hostname,cimport,sslproto,user,password,vendor,verbose,perfdata,urlise_country,timeout,ignore_list,regex,get_power,get_volts,get_current,get_temp,get_fan,get_lcd,get_intrusion,format,pretty
+class CheckFailed(Exception):
+  # Raised when a check cannot continue, carries the UNKNOWN message to report
+  pass
+
+class ClassTimeout(CheckFailed):
+  # Raised when a class could not be fetched within its share of the --timeout,
+  # the check goes on with the other classes
+  pass
+
+class HostUnreachable(CheckFailed):
+  # Raised on connection, HTTP and authentication errors, counted by the circuit breaker
+  pass
+
+class CircuitOpen(CheckFailed):
+  # Raised instead of checking a host whose circuit breaker is open
+  pass
+
+# ----------------------------------------------------------------------
+
+# pywbem's own default timeout of a request, used unless --timeout sets one per request (see run_hostlist)
+DefaultConnTimeout = 30
+
+def conn_timeout(opts):
+  # None would make pywbem wait forever for a host which doesn't answer
+  return opts.conn_timeout or DefaultConnTimeout
+
+def new_connection(opts):
+  verboseoutput("Connection to "+opts.hosturl)
+  if opts.pull > 0:
+    # None lets pywbem try the pull operations first and fall back if the server lacks them
+    return pywbem.WBEMConnection(opts.hosturl, (opts.user,opts.password), NS, no_verification=True, timeout=conn_timeout(opts),
+        use_pull_operations=None)
+  return pywbem.WBEMConnection(opts.hosturl, (opts.user,opts.password), NS, no_verification=True, timeout=conn_timeout(opts))
+
+# ----------------------------------------------------------------------
+
+def class_propertylist(opts, classe):
+  # the properties to ask for, None means all of them
+  if not opts.projection:
+    return None
+  return CommonProperties + ClassProperties.get(classe, [])
+
+def enumerate_class(client, opts, classe):
+  # Enumerate the instances of a class, asking only for the properties we look at
+  if not opts.projection:
+    return client.EnumerateInstances(classe)
+  return client.EnumerateInstances(classe, IncludeQualifiers=False, IncludeClassOrigin=False,
+      PropertyList=class_propertylist(opts, classe))
+
+def iter_class(client, opts, classe):
+  # Like enumerate_class, but returns a generator which uses the WBEM pull operations to get
+  # at most opts.pull instances per request, so only one batch is held in memory at a time.
+  # pywbem falls back to EnumerateInstances if the CIM server does not support pull operations.
+  if not hasattr(client, 'IterEnumerateInstances'):
+    return enumerate_class(client, opts, classe)
+  return client.IterEnumerateInstances(classe, IncludeQualifiers=False, IncludeClassOrigin=False,
+      PropertyList=class_propertylist(opts, classe), MaxObjectCount=opts.pull)
+
+# ----------------------------------------------------------------------
+
+def cache_path(opts, suffix):
+  # file of a host below --cache-dir
+  import re
+  name = re.sub('[^A-Za-z0-9.-]', '_', re.sub('^https://', '', opts.hosturl))
+  return os.path.join(opts.cache_dir, name + suffix)
+
+class HostCache:
+  # Data about one host kept between runs in a JSON file below --cache-dir.
+  # Each feature keeps its own section, a damaged or missing file is an empty cache.
+
+  def __init__(self, opts):
+    self.path = cache_path(opts, '.json')
+    self.data = {}
+    try:
+      import json
+      with open(self.path, 'r') as f:
+        self.data = json.load(f)
+    except (IOError, ValueError) as e:
+      verboseoutput("No usable cache %s: %s" % (self.path, e))
+
+  def get(self, section):
+    return self.data.get(section)
+
+  def set(self, section, value):
+    self.data[section] = value
+
+  def remove(self, section):
+    self.data.pop(section, None)
+
+  def save(self):
+    # write to a temporary file first, so that a concurrent run never reads half a file
+    import json
+    tmppath = "%s.%d.%d" % (self.path, os.getpid(), threading.get_ident())
+    try:
+      with open(tmppath, 'w') as f:
+        json.dump(self.data, f)
+      os.replace(tmppath, self.path)
+    except (IOError, OSError) as e:
+      verboseoutput("Cannot write cache %s: %s" % (self.path, e))
+
+# ----------------------------------------------------------------------
+
+def cache_value(value):
+  # convert a CIM property value into something JSON can store
+  if value is None or isinstance(value, (bool, str)):
+    return value
+  if isinstance(value, list):
+    return [cache_value(v) for v in value]
+  if isinstance(value, pywbem.CIMDateTime):
+    return {'datetime': str(value)}
+  if isinstance(value, int):
+    return int(value)
+  if isinstance(value, float):
+    return float(value)
+  return str(value)
+
+def cached_value(value):
+  if isinstance(value, list):
+    return [cached_value(v) for v in value]
+  if isinstance(value, dict):
+    return pywbem.CIMDateTime(value['datetime'])
+  return value
+
+class CachedInstance(dict):
+  # Instance properties restored from the cache, looked up case-insensitively like a CIMInstance
+  def __init__(self, properties):
+    dict.__init__(self, ((k.lower(), cached_value(v)) for k, v in properties.items()))
+
+  def __getitem__(self, key):
+    return dict.__getitem__(self, key.lower())
+
+# ----------------------------------------------------------------------
+
+def refresh_intervals(opts):
+  # the refresh interval of each class reused from the cache (--tiered, --refresh)
+  intervals = {}
+  if opts.tiered:
+    intervals.update(ClassRefresh)
+  for entry in opts.refresh:
+    classe, seconds = entry.split('=')
+    intervals[classe] = int(seconds)
+  return intervals
+
+def slope_alerts(opts):
+  # (sensor type, change, seconds) of each --slope, raises ValueError for an invalid one
+  alerts = []
+  types = dict((name.lower().replace(' ', '_'), code) for code, name in sensor_Type.items())
+  for entry in opts.slope:
+    sensorType, sep, rest = entry.partition('=')
+    change, sep2, minutes = rest.partition('/')
+    if not (sep and sep2) or sensorType.lower() not in types:
+      raise ValueError(entry)
+    change, minutes = float(change), float(minutes)
+    if change == 0 or minutes <= 0:
+      raise ValueError(entry)
+    alerts.append((types[sensorType.lower()], change, minutes * 60))
+  return alerts
+
+# ----------------------------------------------------------------------
+
+# smallest number of sensor slots of a history file
+HistoryMinSlots = 16
+
+class SensorHistory:
+  # The last --history readings of each numeric sensor of a host, in a memory-mapped file below
+  # --cache-dir: a header followed by a hash table of slots, each with a hash of the sensor name,
+  # the position of the newest reading, the number of readings, the run which wrote it last and
+  # a ring of (time, value) pairs. A sensor is found by probing from its hash, so a check reads
+  # and writes a constant amount per sensor. The table is kept at most half full, it is rebuilt
+  # (begin) when the host reports more sensors or holds slots of sensors not written for
+  # --history runs, which are dropped. Otherwise the file does not change its size.
+
+  magic = b'ESXH'
+
+  def __init__(self, opts):
+    import struct
+    self.depth = opts.history
+    self.header = struct.Struct('<4sIIIQ')
+    self.slot_header = struct.Struct('<QIIQ')
+    self.reading = struct.Struct('<dd')
+    self.slot_size = self.slot_header.size + self.depth * self.reading.size
+    fd = os.open(cache_path(opts, '.history'), os.O_RDWR | os.O_CREAT, 0o600)
+    self.file = os.fdopen(fd, 'r+b')
+    try:
+      import fcntl
+      fcntl.flock(fd, fcntl.LOCK_EX)
+    except ImportError:
+      pass
+    self.map = None
+    size = os.fstat(fd).st_size
+    if size >= self.header.size:
+      self.map_file(size)
+      magic, self.slots, depth, self.used, self.run = self.header.unpack_from(self.map, 0)
+      if magic == self.magic and depth == self.depth and self.slots and size == self.size(self.slots):
+        return
+      # a damaged file or one of another --history
+      self.map.close()
+    self.reset(HistoryMinSlots, 0)
+
+  def size(self, slots):
+    return self.header.size + slots * self.slot_size
+
+  def map_file(self, size):
+    import mmap
+    self.map = mmap.mmap(self.file.fileno(), size)
+
+  def reset(self, slots, run):
+    # an empty table of the given number of slots
+    if self.map is not None:
+      self.map.close()
+    self.file.truncate(0)
+    self.file.truncate(self.size(slots))
+    self.map_file(self.size(slots))
+    self.slots, self.used, self.run = slots, 0, run
+    self.write_header()
+
+  def write_header(self):
+    self.header.pack_into(self.map, 0, self.magic, self.slots, self.depth, self.used, self.run)
+
+  def close(self):
+    self.write_header()
+    self.map.close()
+    self.file.close()
+
+  def begin(self, sensors):
+    # Starts the run of a check reporting the given number of sensors. More used slots than
+    # sensors mean some sensors weren't reported, they are dropped once they haven't been
+    # written for --history runs.
+    self.run += 1
+    if self.used <= sensors and 2 * sensors <= self.slots:
+      return
+    kept = []
+    for i in range(self.slots):
+      offset = self.header.size + i * self.slot_size
+      key, head, count, run = self.slot_header.unpack_from(self.map, offset)
+      if key and run > self.run - 1 - self.depth:
+        kept.append((key, bytes(self.map[offset:offset + self.slot_size])))
+    slots = HistoryMinSlots
+    while slots < 2 * (len(kept) + sensors):
+      slots *= 2
+    verboseoutput("Sensor history of %d sensors rebuilt with %d slots, %d dropped" % (len(kept), slots, self.used - len(kept)))
+    self.reset(slots, self.run)
+    for key, slot in kept:
+      offset = self.find(key)
+      self.map[offset:offset + self.slot_size] = slot
+      self.used += 1
+
+  def find(self, key):
+    # offset of the slot of key or of the free slot where it belongs, None if the table is full
+    start = key % self.slots
+    for i in range(self.slots):
+      offset = self.header.size + (start + i) % self.slots * self.slot_size
+      slotkey = self.slot_header.unpack_from(self.map, offset)[0]
+      if slotkey == key or slotkey == 0:
+        return offset
+    return None
+
+  def add(self, name, now, value):
+    # Adds a reading of a sensor and returns all kept readings of it as (time, value),
+    # or None if there is no slot left for it
+    import hashlib
+    key = int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+    offset = self.find(key)
+    if offset is None:
+      return None
+    slotkey, head, count, run = self.slot_header.unpack_from(self.map, offset)
+    if slotkey == 0:
+      self.used += 1
+    head = (head + 1) % self.depth
+    count = min(count + 1, self.depth)
+    base = offset + self.slot_header.size
+    self.reading.pack_into(self.map, base + head * self.reading.size, now, value)
+    self.slot_header.pack_into(self.map, offset, key, head, count, self.run)
+    return [self.reading.unpack_from(self.map, base + (head - i) % self.depth * self.reading.size)
+        for i in range(count)]
+
+# ----------------------------------------------------------------------
+
+class IgnoreList:
+  # Elements to ignore: the names in a set and, with --regex, the expressions as one compiled
+  # alternation, so an element costs one set lookup and one regex search. Expressions which
+  # can't be part of the alternation (see ignore_pattern) are searched for one by one.
+  def __init__(self, regex):
+    self.regex = regex
+    self.names = set()
+    self.combined = []
+    self.alternation = None
+    self.patterns = []
+
+  def add(self, entries):
+    combined = len(self.combined)
+    for entry in entries:
+      # an empty entry (e.g. from -i "") would match every element as regular expression
+      if not entry or entry in self.names:
+        continue
+      self.names.add(entry)
+      if self.regex:
+        pattern, alone = ignore_pattern(entry)
+        if alone:
+          self.patterns.append(pattern)
+        elif pattern is not None:
+          self.combined.append(entry)
+    if len(self.combined) > combined:
+      self.alternation = ignore_alternation(tuple(self.combined))
+
+  def match(self, elementName):
+    # returns 'name' or 'regex' if the element is to be ignored, None otherwise
+    if elementName in self.names:
+      return 'name'
+    if self.alternation is not None and self.alternation.search(elementName):
+      return 'regex'
+    for pattern in self.patterns:
+      if pattern.search(elementName):
+        return 'regex'
+    return None
+
+# compiled ignore expressions by their entry and alternations by their entries, so daemon and
+# host list runs compile each one only once
+ignore_patterns = {}
+
+# inline flags like (?s) apply to the whole expression, they can't be part of an alternation
+ignore_global_flags = r'\(\?[aiLmsux]+\)'
+
+def ignore_pattern(entry):
+  # Returns the compiled entry, None for an entry which isn't a valid expression (it then only
+  # matches by name), and whether it has to be searched for on its own: with global inline
+  # flags, or with groups which back references in the alternation would count differently
+  if entry not in ignore_patterns:
+    import re
+    try:
+      pattern = re.compile(entry, re.IGNORECASE)
+      ignore_patterns[entry] = (pattern, bool(pattern.groups or re.search(ignore_global_flags, entry)))
+    except re.error as e:
+      verboseoutput("Ignore entry '%s' is no valid regular expression (%s), matching it by name only" % (entry, e))
+      ignore_patterns[entry] = (None, False)
+  return ignore_patterns[entry]
+
+def ignore_alternation(entries):
+  if entries not in ignore_patterns:
+    import re
+    ignore_patterns[entries] = re.compile('|'.join('(?:%s)' % e for e in entries), re.IGNORECASE)
+  return ignore_patterns[entries]
+
+def build_ignore_list(opts):
+  # -i takes a comma-separated list, or file:<path> with one element (or expression) per line
+  # where empty lines and lines starting with # are skipped
+  if opts.ignore.startswith('file:'):
+    try:
+      with open(opts.ignore[5:], 'r') as f:
+        entries = [line.strip() for line in f if not line.lstrip().startswith('#')]
+    except IOError as e:
+      raise CheckFailed("UNKNOWN: Cannot read ignore list: %s" % e)
+  else:
+    entries = opts.ignore.split(',')
+
+  # Append lcd related elements to ignore list if --no-lcd was used
+  verboseoutput("LCD Status: %s" % opts.get_lcd)
+  if not opts.get_lcd:
+    entries.extend(lcd_elements)
+
+  # Append chassis intrusion related elements to ignore list if --no-intrusion was used
+  verboseoutput("Chassis Intrusion Status: %s" % opts.get_intrusion)
+  if not opts.get_intrusion:
+    entries.extend(intrusion_elements)
+
+  ignore = IgnoreList(opts.regex)
+  ignore.add(entries)
+  return ignore
+
+# ----------------------------------------------------------------------
+
+class ConnectionPool:
+  # Keeps idle WBEM connections per host and credentials, so that later checks reuse
+  # their HTTP session (keep-alive, no new TLS handshake and authentication).
+  # A connection is only handed to one thread at a time.
+
+  def __init__(self):
+    self.idle = {}
+    self.lock = threading.Lock()
+
+  def get(self, opts):
+    key = (opts.hosturl, opts.user, opts.password)
+    with self.lock:
+      if self.idle.get(key):
+        return self.idle[key].pop()
+    return new_connection(opts)
+
+  def put(self, opts, conn):
+    key = (opts.hosturl, opts.user, opts.password)
+    with self.lock:
+      self.idle.setdefault(key, []).append(conn)
+
+# ----------------------------------------------------------------------
+
+def fetch_instances(fetch, *args, errors=None):
+  # Call fetch(*args) and turn pywbem errors into the plugin's reaction:
+  # fatal errors raise CheckFailed, other CIM errors are logged (and appended to 'errors')
+  # and None is returned
+  try:
+    return fetch(*args)
+  except PywbemCimOperations.CIMError as args:
+    if ( str(args).find('Socket error') >= 0 ):
+      raise CheckFailed("UNKNOWN: {}".format(args))
+    elif ( str(args).find('ThreadPool --- Failed to enqueue request') >= 0 ):
+      raise CheckFailed("UNKNOWN: {}".format(args))
+    else:
+      verboseoutput("Unknown CIM Error: %s" % args)
+      if errors is not None:
+        errors.append(args)
+  except PywbemExceptions.TimeoutError as args:
+    raise ClassTimeout("UNKNOWN: {}".format(args))
+  except PywbemExceptions.ConnectionError as args:
+    raise HostUnreachable("UNKNOWN: {}".format(args))
+  except PywbemExceptions.HTTPError as args:
+    raise HostUnreachable("UNKNOWN: {}".format(args))
+  except PywbemCimHttp.AuthError as arg:
+    verboseoutput("Global exit set to UNKNOWN")
+    raise HostUnreachable("UNKNOWN: Authentication Error")
+  return None
+
+def transient_error(e):
+  # Errors of an overloaded CIM server (sfcbd) which are worth a retry, not a timeout though
+  # as the request already took all the time it had
+  if isinstance(e, PywbemExceptions.TimeoutError):
+    return False
+  if isinstance(e, PywbemExceptions.ConnectionError):
+    return True
+  return str(e).find('Socket error') >= 0 or str(e).find('ThreadPool --- Failed to enqueue request') >= 0
+
+# ----------------------------------------------------------------------
+
+# request slots per host (--host-limit), shared by all checks of this process
+host_limiters = {}
+# protects host_limiters and breakers
+host_state_lock = threading.Lock()
+
+def host_limiter(opts):
+  with host_state_lock:
+    if opts.hosturl not in host_limiters:
+      host_limiters[opts.hosturl] = threading.BoundedSemaphore(opts.host_limit)
+    return host_limiters[opts.hosturl]
+
+# ----------------------------------------------------------------------
+
+class CircuitBreaker:
+  # Keeps hosts which keep failing from being checked over and over (--breaker). After
+  # 'threshold' checks in a row failed with connection, HTTP or authentication errors, the
+  # circuit opens and checks return the last error right away for --breaker-cooldown seconds.
+  # Then a single check is let through as probe: the circuit closes if it reaches the host,
+  # else it stays open for another cool-down period.
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.failures = 0
+    self.opened = 0
+    self.error = ''
+    self.probing = False
+    self.restored = False
+
+  def allow(self, opts):
+    # Returns None if the host may be checked, else the message to report instead
+    with self.lock:
+      if self.failures < opts.breaker:
+        return None
+      wait = self.opened + opts.breaker_cooldown - time.time()
+      if wait <= 0 and not self.probing:
+        verboseoutput("Circuit breaker of %s: probing the host" % opts.hostname)
+        self.probing = True
+        return None
+      return "%s (failed %d times in a row, next check in %ds)" % (self.error, self.failures, max(wait, 0))
+
+  def record(self, opts, failed, error):
+    with self.lock:
+      self.probing = False
+      if not failed:
+        self.failures = 0
+        return
+      self.failures += 1
+      self.error = error
+      if self.failures >= opts.breaker:
+        verboseoutput("Circuit breaker of %s open for %ds" % (opts.hostname, opts.breaker_cooldown))
+        self.opened = time.time()
+
+  def state(self):
+    return {'failures': self.failures, 'opened': self.opened, 'error': self.error}
+
+  def restore(self, state):
+    # take over the state of an earlier run from the cache, once
+    with self.lock:
+      if not self.restored and state:
+        self.failures, self.opened, self.error = state['failures'], state['opened'], state['error']
+      self.restored = True
+
+# circuit breakers per host, shared by all checks of this process
+breakers = {}
+
+def host_breaker(opts):
+  with host_state_lock:
+    if opts.hosturl not in breakers:
+      breakers[opts.hosturl] = CircuitBreaker()
+    return breakers[opts.hosturl]
+
+# ----------------------------------------------------------------------
+
+def connection_stats(client):
+  # Returns the number of requests, bytes received and server time (as far as the CIM server
+  # reports it) of a connection so far, all 0 if it doesn't keep statistics
+  requests = received = server = 0
+  if getattr(client, 'stats_enabled', False):
+    for name, stat in client.statistics.snapshot():
+      requests += stat.count
+      received += stat.count * stat.avg_reply_len
+      server += stat.count * stat.avg_server_time
+  return requests, received, server
+
+# ----------------------------------------------------------------------
+
+def collect_parallel(check, classes, width):
+  # Start fetching the given classes on up to 'width' worker threads, each with its own
+  # connection. Returns a dict of futures per class, the evaluation itself stays in the
+  # main loop so that status and perfdata come out exactly as in sequential mode.
+  # Worker threads are daemonic so a timeout or an early exit never waits for them.
+  from concurrent.futures import Future
+  futures = {}
+  pending = list(classes)
+  lock = threading.Lock()
+  for classe in classes:
+    futures[classe] = Future()
+
+  def worker():
+    client = None
+    failed = False
+    classe = None
+    try:
+      while True:
+        with lock:
+          if not pending:
+            break
+          classe = pending.pop(0)
+          # the classes still to come are shared by all workers
+          rounds = len(pending) // width + 1
+        verboseoutput("Fetching classe "+classe)
+        try:
+          if client is None:
+            client = check.connect()
+          client = check.set_budget(client, classe, rounds)
+          futures[classe].set_result(check.fetch_class(client, classe))
+        except Exception as e:
+          futures[classe].set_exception(e)
+          failed = True
+        classe = None
+    finally:
+      # whatever stops the worker, the main loop must not wait for a class it took or,
+      # once no worker is left, for the classes nobody took
+      with lock:
+        alive[0] -= 1
+        owned = [classe] if classe else []
+        if not alive[0]:
+          owned += pending
+          del pending[:]
+      for classe in owned:
+        if not futures[classe].done():
+          futures[classe].set_exception(CheckFailed("UNKNOWN: fetching %s was aborted" % classe))
+    if client is not None and not failed:
+      check.release(client)
+
+  alive = [min(width, len(classes))]
+  for i in range(alive[0]):
+    t = threading.Thread(target=worker)
+    t.daemon = True
+    t.start()
+  return futures
+
+# ----------------------------------------------------------------------
+
+def detect_vendor(man):
+  if man.startswith("Dell"):
+    return "dell"
+  elif man.startswith("HP"):
+    return "hp"
+  elif man.startswith("IBM"):
+    return "ibm"
+  elif man.startswith("Intel"):
+    return "intel"
+  return 'unknown'
+
+# ----------------------------------------------------------------------
+
+def read_credentials(opts):
+  # if user or password starts with 'file:', use the first string in file as user, second as password
+  if (opts.user.startswith('file:') or opts.password.startswith('file:')):
+        if opts.user.startswith('file:'):
+          filextract = opts.user[5:]
+          filename = open(filextract, 'r')
+          filetext = filename.readline().split()
+          opts.user = filetext[0]
+          opts.password = filetext[1]
+          filename.close()
+        elif opts.password.startswith('file:'):
+          filextract = opts.password[5:]
+          filename = open(filextract, 'r')
+          filetext = filename.readline().split()
+          opts.password = filetext[0]
+          filename.close()
+
+# ----------------------------------------------------------------------
+
+def set_host(opts, host):
+  opts.hostname=host.lower()
+  # if user has put "https://" in front of hostname out of habit, do the right thing
+  # hosturl will end up as https://hostname
+  if opts.hostname.startswith('https://'):
+    opts.hosturl = opts.hostname
+  else:
+    opts.hosturl = 'https://' + opts.hostname
+
+# ----------------------------------------------------------------------
+
+def option_parser() :
   usage = "usage: %prog -H hostname -U username -P password [-C port -S proto -V vendor -v -p -I XX -i list,list -r]\n" \
     "example: %prog -H hostname -U root -P password -C 5989 -V auto -I uk\n\n" \
     "or, verbosely:\n\n" \
-    "usage: %prog --host=hostname --user=username --pass=password [--cimport=port --sslproto=version --vendor=system --verbose --perfdata --html=XX --format=json --pretty]\n"
+    "usage: %prog --host=hostname --user=username --pass=password [--cimport=port --sslproto=version --vendor=system --verbose --perfdata --html=XX --format=json --pretty]\n\n" \
+    "or, for many hosts at once:\n\n" \
+    "usage: %prog --hostlist=file [--user=username --pass=password --workers=N ...]\n\n" \
+    "or as daemon, with the usual options plus --socket=path on the client side:\n\n" \
+    "usage: %prog --daemon --socket=path [--interval=seconds --workers=N]\n"
 
   parser = OptionParser(usage=usage, version="%prog "+version)
   group1 = OptionGroup(parser, 'Mandatory parameters')
@@ -581,8 +1247,103 @@ def getopts() :
       help="generate html links for country XX (default is not to)", metavar="XX")
   group2.add_option("-t", "--timeout", action="store", type="int", dest="timeout", default=0, \
       help="timeout in seconds - no effect on Windows (default = no timeout)")
+  group2.add_option("--parallel", action="store", type="int", dest="parallel", default=1, \
+      help="number of CIM classes to fetch concurrently (default = 1, sequential)", metavar="N")
+  group2.add_option("--retries", action="store", type="int", dest="retries", default=0, \
+      help="retry a class up to N times after transient errors of an overloaded CIM server (Socket error, " \
+      "ThreadPool --- Failed to enqueue request, connection errors), within --timeout (default = 0)", metavar="N")
+  group2.add_option("--retry-delay", action="store", type="float", dest="retry_delay", default=1.0, \
+      help="seconds before the first retry, doubled for each further one and varied by +-50% (default = 1)", \
+      metavar="SECONDS")
+  group2.add_option("--host-limit", action="store", type="int", dest="host_limit", default=0, \
+      help="at most N concurrent CIM requests to one host from this process, e.g. with --parallel, " \
+      "--hostlist or the daemon (default = 0, no limit)", metavar="N")
+  group2.add_option("--breaker", action="store", type="int", dest="breaker", default=0, \
+      help="after N checks of a host in a row failed with connection, HTTP or authentication errors, " \
+      "report the last error without contacting the host for --breaker-cooldown seconds. Within one " \
+      "process (daemon, --hostlist) or across runs with --cache-dir (default = 0, off)", metavar="N")
+  group2.add_option("--breaker-cooldown", action="store", type="int", dest="breaker_cooldown", default=300, \
+      help="seconds until a host is checked again once the circuit breaker is open (default = 300)", \
+      metavar="SECONDS")
+  group2.add_option("--no-projection", action="store_false", dest="projection", default=True, \
+      help="fetch all properties of each element instead of only the ones the check uses")
+  group2.add_option("--pull", action="store", type="int", dest="pull", default=0, \
+      help="use WBEM pull operations fetching at most N elements per request and evaluate them while " \
+      "they arrive, keeping memory use flat on large hosts (default = 0, off). Not used for classes " \
+      "fetched with --parallel", metavar="N")
+  group2.add_option("--fast-health", action="store_true", dest="fast_health", default=False, \
+      help="let the CIM server return only elements whose HealthState is not OK (WQL ExecQuery), with " \
+      "vendor hp where the status comes from HealthState. Classes for which this fails are fetched " \
+      "completely, with --cache-dir also in later runs")
+  group2.add_option("--cache-dir", dest="cache_dir", default="", \
+      help="keep per-host data between runs in DIR, e.g. which classes a host doesn't implement, " \
+      "so they are not asked for again (default = no cache)", metavar="DIR")
+  group2.add_option("--cache-ttl", action="store", type="int", dest="cache_ttl", default=86400, \
+      help="seconds after which cached host data is refreshed (default = 86400)", metavar="SECONDS")
+  group2.add_option("--tiered", action="store_true", dest="tiered", default=False, \
+      help="with --cache-dir, reuse the last result of rarely changing classes (%s) for an hour " \
+      "instead of fetching them on every run" % ", ".join(sorted(ClassRefresh)))
+  group2.add_option("--refresh", action="append", dest="refresh", default=[], \
+      help="with --cache-dir, reuse the last result of CLASS for SECONDS, may be given several times", \
+      metavar="CLASS=SECONDS")
+  group2.add_option("--timings", action="store_true", dest="timings", default=False, \
+      help="measure requests, bytes received, fetch and evaluation time per CIM class, reported " \
+      "as performance data (cim_time_CLASS, cim_bytes_CLASS), in the JSON output and with --verbose")
+  group2.add_option("--profile", dest="profile", default="", \
+      help="profile the whole run with cProfile and write the statistics to FILE, with --verbose " \
+      "also print the functions taking the most time", metavar="FILE")
+  group2.add_option("--profile-memory", action="store_true", dest="profile_memory", default=False, \
+      help="with --profile, also trace memory allocations with tracemalloc and write the biggest " \
+      "ones to FILE.memory")
+  group2.add_option("--profile-top", action="store", type="int", dest="profile_top", default=20, \
+      help="number of entries printed with --profile and --verbose (default = 20)", metavar="N")
+  group2.add_option("--history", action="store", type="int", dest="history", default=0, \
+      help="with --cache-dir, keep the last N readings of each numeric sensor in a file of fixed size " \
+      "per host, for --slope (default = 0, off)", metavar="N")
+  group2.add_option("--slope", action="append", dest="slope", default=[], \
+      help="with --history, warn if a sensor of TYPE (e.g. temperature, tachometer) changed by CHANGE " \
+      "or more within MINUTES, rising for a positive CHANGE and falling for a negative one " \
+      "(e.g. temperature=5/10 or tachometer=-2000/5), may be given several times", metavar="TYPE=CHANGE/MINUTES")
+  group2.add_option("--sel", action="store_true", dest="sel", default=False, \
+      help="with --cache-dir, alert on log records (SEL) with a warning or critical severity which " \
+      "appeared since the last run")
+  group2.add_option("--sel-hold", action="store", type="int", dest="sel_hold", default=3600, \
+      help="with --sel, keep alerting on a new severe log record for SECONDS after it was found, so " \
+      "that soft states become hard (default = 3600, 0 = only on the run which finds it)", metavar="SECONDS")
+  group2.add_option("--hostlist", dest="hostlist", default="", \
+      help="check all hosts listed in FILE ('-' for stdin), one host per line, optionally followed by " \
+      "user=, password=, cimport=, vendor=, ignore=, service= and hostname= overrides, hostname= being " \
+      "the host name of the passive check results (default = the host as written, without https://)", metavar="FILE")
+  group2.add_option("--workers", action="store", type="int", dest="workers", default=10, \
+      help="number of hosts checked concurrently with --hostlist (default = 10)", metavar="N")
+  group2.add_option("--async", action="store_true", dest="use_async", default=False, \
+      help="with --hostlist, check all hosts from one asyncio event loop. --workers then limits the " \
+      "CIM requests in flight over all hosts and --parallel the ones per host")
+  group2.add_option("--command-file", dest="command_file", default="", \
+      help="with --hostlist, submit the results as passive check results to the external command " \
+      "file of Nagios/Icinga instead of printing them", metavar="FILE")
+  group2.add_option("--spool-dir", dest="spool_dir", default="", \
+      help="with --hostlist, write the results as Icinga2 API process-check-result requests to " \
+      "JSON files in DIR instead of printing them", metavar="DIR")
+  group2.add_option("--service", dest="service", default="ESXi Hardware", \
+      help="service the passive check results are submitted for (default = 'ESXi Hardware')", metavar="NAME")
+  group2.add_option("--batch", action="store", type="int", dest="batch", default=100, \
+      help="passive check results submitted at once with --command-file or --spool-dir (default = 100)", metavar="N")
+  group2.add_option("--daemon", action="store_true", dest="daemon", default=False, \
+      help="run as daemon which keeps connections open and serves check results on --socket")
+  group2.add_option("--socket", dest="socket", default="", \
+      help="UNIX socket of the daemon. Without --daemon the result is requested from a daemon " \
+      "listening there, if none answers the check runs as usual", metavar="PATH")
+  group2.add_option("--interval", action="store", type="int", dest="interval", default=60, \
+      help="seconds between background checks of each host in daemon mode (default = 60)", metavar="SECONDS")
+  group2.add_option("--max-age", action="store", type="int", dest="max_age", default=0, \
+      help="maximum age of a result served by the daemon before it is checked again on request " \
+      "(default = 0, any result kept up to date by the daemon)", metavar="SECONDS")
+  group2.add_option("--exporter", dest="exporter", default="", \
+      help="with --hostlist, check the hosts every --interval seconds in the background and serve the " \
+      "sensor readings and element states as Prometheus metrics on http://[ADDR:]PORT/metrics", metavar="[ADDR:]PORT")
   group2.add_option("-i", "--ignore", action="store", type="string", dest="ignore", default="", \
-      help="comma-separated list of elements to ignore")
+      help="comma-separated list of elements to ignore, or file:<path> with one element per line")
   group2.add_option("-r", "--regex", action="store_true", dest="regex", default=False, \
       help="allow regular expression lookup of ignore list")
   group2.add_option("--no-power", action="store_false", dest="get_power", default=True, \
@@ -599,13 +1360,19 @@ def getopts() :
       help="don't collect lcd/front display status")
   group2.add_option("--no-intrusion", action="store_false", dest="get_intrusion", default=True, \
       help="don't collect chassis intrusion status")
-  group2.add_option("--format", dest="format", help="'string' (default) or 'json'", \
-      metavar="FORMAT", type='choice', choices=['string','json'],default="string")
+  group2.add_option("--format", dest="format", help="'string' (default), 'json', or 'ndjson' or 'influx' " \
+      "(line protocol) to write a record per element while the check runs, followed by one for the check", \
+      metavar="FORMAT", type='choice', choices=['string','json','ndjson','influx'],default="string")
   group2.add_option("--pretty", action="store_true", dest="pretty", default=False, \
       help="return data as a pretty-printed json-array")
 
   parser.add_option_group(group1)
   parser.add_option_group(group2)
+  return parser
+
+def getopts() :
+  global verbose
+  parser = option_parser()
 
   # check input arguments
   if len(sys.argv) < 2:
@@ -613,490 +1380,2009 @@ def getopts() :
     parser.print_help()
     sys.exit(3)
   # if first argument starts with 'https://' we have old-style parameters, so handle in old way
-  if re.match("https://",sys.argv[1]):
+  if sys.argv[1].startswith("https://"):
     # check input arguments
     if len(sys.argv) < 5:
       print("too few parameters\n")
       parser.print_help()
       sys.exit(3)
+    options = parser.get_default_values()
     if len(sys.argv) > 5 :
       if sys.argv[5] == "verbose" :
-        verbose = True
-    hosturl = sys.argv[1]
-    user = sys.argv[2]
-    password = sys.argv[3]
-    vendor = sys.argv[4]
+        options.verbose = True
+    options.hostname = ''
+    options.hosturl = sys.argv[1]
+    options.user = sys.argv[2]
+    options.password = sys.argv[3]
+    options.vendor = sys.argv[4]
   else:
     # we're dealing with new-style parameters, so go get them!
     (options, args) = parser.parse_args()
 
     # Making sure all mandatory options appeared.
+    # With --hostlist the host comes from the list and credentials may be given per host.
     mandatories = ['host', 'user', 'password']
+    if options.hostlist or options.daemon:
+      mandatories = []
     for m in mandatories:
       if not options.__dict__[m]:
         print("mandatory option '" + m + "' not defined. read usage in help.\n")
         parser.print_help()
         sys.exit(3)
 
-    hostname=options.host.lower()
-    # if user has put "https://" in front of hostname out of habit, do the right thing
-    # hosturl will end up as https://hostname
-    if re.match('^https://',hostname):
-      hosturl = hostname
+    if options.host:
+      set_host(options, options.host)
+    else:
+      options.hostname = ''
+      options.hosturl = ''
+    options.urlise_country=options.urlise_country.lower()
+    options.vendor=options.vendor.lower()
+    options.parallel=max(1, options.parallel)
+    options.workers=max(1, options.workers)
+    options.interval=max(1, options.interval)
+    options.batch=max(1, options.batch)
+    for entry in options.refresh:
+      classe, sep, seconds = entry.partition('=')
+      if not (classe.replace('_', '').isalnum() and seconds.isdigit()):
+        print("invalid refresh interval '%s', expected CLASS=SECONDS. read usage in help.\n" % entry)
+        parser.print_help()
+        sys.exit(3)
+    if (options.sel or options.tiered or options.refresh or options.history) and not options.cache_dir:
+      print("options '--sel', '--tiered', '--refresh' and '--history' require '--cache-dir'. read usage in help.\n")
+      parser.print_help()
+      sys.exit(3)
+    try:
+      slope_alerts(options)
+    except ValueError as e:
+      print("invalid slope '%s', expected TYPE=CHANGE/MINUTES. read usage in help.\n" % e)
+      parser.print_help()
+      sys.exit(3)
+    if options.slope and options.history < 2:
+      print("option '--slope' requires '--history' of at least 2. read usage in help.\n")
+      parser.print_help()
+      sys.exit(3)
+    if options.exporter and not options.hostlist:
+      print("option '--exporter' requires '--hostlist'. read usage in help.\n")
+      parser.print_help()
+      sys.exit(3)
+    if (options.command_file or options.spool_dir) and not options.hostlist:
+      print("options '--command-file' and '--spool-dir' require '--hostlist'. read usage in help.\n")
+      parser.print_help()
+      sys.exit(3)
+    if options.command_file and options.spool_dir:
+      print("options '--command-file' and '--spool-dir' cannot be used together. read usage in help.\n")
+      parser.print_help()
+      sys.exit(3)
+    if options.daemon and not options.socket:
+      print("option '--daemon' requires '--socket'. read usage in help.\n")
+      parser.print_help()
+      sys.exit(3)
+
+  # the check itself relies on signal.alarm, per-request socket timeouts are only used
+  # where that is not possible (see run_hostlist)
+  options.conn_timeout = None
+  verbose = options.verbose
+  return options
+
+# ----------------------------------------------------------------------
+
+class SensorReading:
+  # Reading of one numeric sensor, scaled by its UnitModifier, with the thresholds (0 if not set)
+  # and the status of the sensor. Only these values are kept, not the CIM instance.
+  __slots__ = ('name', 'sensor_type', 'units', 'value', 'lower_warn', 'upper_warn', 'lower_crit', 'upper_crit', 'status')
+
+  def __init__(self, name, sensor_type, units, value, lower_warn, upper_warn, lower_crit, upper_crit):
+    self.name = name
+    self.sensor_type = None if sensor_type is None else int(sensor_type)
+    self.units = None if units is None else int(units)
+    self.value = value
+    self.lower_warn = lower_warn
+    self.upper_warn = upper_warn
+    self.lower_crit = lower_crit
+    self.upper_crit = upper_crit
+    self.status = None
+
+  def perfgroup(self, opts):
+    # Returns the performance data group (see perf_Prefix) and unit of this sensor,
+    # or None if it isn't part of the performance data
+    if self.sensor_type == 4:               # Current or Power Consumption
+      if self.units == 7 and opts.get_power:              # Watts
+        return 1, 'Watt'
+      elif self.units == 6 and opts.get_current:          # Current
+        return 3, 'Ampere'
+    elif self.sensor_type == 3 and opts.get_volts:        # Voltage
+      return 2, 'Volt'
+    elif self.sensor_type == 2 and opts.get_temp:         # Temperature
+      return 4, None
+    elif self.sensor_type == 5 and opts.get_fan:          # Tachometer
+      if self.units == 65:                                # percentage
+        return 6, '%'
+      return 5, None
+    return None
+
+  def as_dict(self):
+    d = dict((attr, getattr(self, attr)) for attr in self.__slots__)
+    d['type'] = sensor_Type.get(self.sensor_type, "Unknown")
+    return d
+
+  def __repr__(self):
+    return "<SensorReading %s %g>" % (self.name, self.value)
+
+# ----------------------------------------------------------------------
+
+class HostCheck:
+  # Runs the check against one host and keeps its results.
+  # All state of a run lives here so that several hosts can be checked in one process.
+
+  def __init__(self, opts, pool=None):
+    import_pywbem()
+    self.opts = opts
+    self.pool = pool
+    self.vendor = opts.vendor
+    self.GlobalStatus = ExitUnknown
+    self.ExitMsg = ""
+    self.server_info = ""
+    self.bios_info = ""
+    self.SerialNumber = ""
+    self.SerialChassis = ""
+    # Special handling for blade servers
+    self.isblade = "no"
+    self.xdata = {}
+    self.failure = None
+    # with --timeout, the classes are fetched until shortly before it runs out, leaving time
+    # for the evaluation, the classes which didn't make it are listed in the output
+    self.start_deadline()
+    self.timed_out = []
+    # status of each evaluated element and the readings of the numeric sensors (SensorReading),
+    # the performance data is rendered from the latter in output()
+    self.elements = {}
+    self.element_classes = {}
+    self.sensors = []
+    # severe log records which still alert (--sel-hold)
+    self.held_records = []
+    # records of the evaluated elements are written while the check runs with --format ndjson or influx
+    self.stream = None
+    if opts.format in StreamFormats:
+      self.stream = RecordStream(opts)
+
+    # classes fetched through a query for unhealthy elements (--fast-health)
+    self.queried = set()
+    self.query_supported = True
+    # classes the query failed for, kept in the capability cache (--cache-dir)
+    self.no_query = set()
+    self.no_query_found = False
+
+    # classes the host is probed for in this run (--cache-dir)
+    self.cache = None
+    self.capabilities = None
+    # ESXi version and build, part of the capability cache signature
+    self.esxi_build = None
+    self.chassis_manufacturer = None
+    self.chassis_serial = None
+    # classes with a refresh interval and the freshly fetched instances of them (--tiered)
+    self.tiers = {}
+    self.results = {}
+    if opts.cache_dir:
+      self.cache = HostCache(opts)
+      self.tiers = refresh_intervals(opts)
+
+    # per class: requests, bytes received, fetch/server/evaluation time and instances (--timings)
+    self.timings = None
+    if opts.timings:
+      self.timings = {}
+
+    # elements to ignore (full SEL, broken BIOS, etc), and classes which are skipped
+    # or taken from the cache, set up by prepare()
+    self.ignore = None
+    self.skip = set()
+    self.cached = {}
+
+  # ----------------------------------------------------------------------
+
+  def start_deadline(self):
+    # --timeout counts from here, AsyncHostChecker restarts it once the host gets a request slot
+    self.deadline = None
+    if self.opts.timeout > 0:
+      self.deadline = time.time() + self.opts.timeout * 0.9
+
+  def connect(self):
+    if self.pool:
+      client = self.pool.get(self.opts)
     else:
-      hosturl = 'https://' + hostname
-
-    user=options.user
-    password=options.password
-    cimport=options.cimport
-    ignore_list=options.ignore.split(',')
-    format=options.format
-    pretty=options.pretty
-    perfdata=options.perfdata
-    regex=options.regex
-    sslproto=options.sslproto
-    timeout=options.timeout
-    urlise_country=options.urlise_country.lower()
-    vendor=options.vendor.lower()
-    verbose=options.verbose
-    get_power=options.get_power
-    get_volts=options.get_volts
-    get_current=options.get_current
-    get_temp=options.get_temp
-    get_fan=options.get_fan
-    get_lcd=options.get_lcd
-    get_intrusion=options.get_intrusion
+      client = new_connection(self.opts)
+    if self.timings is not None and hasattr(client, 'stats_enabled'):
+      client.stats_enabled = True
+    return client
+
+  def release(self, conn):
+    # hand a connection which is still good back to the pool
+    if self.pool:
+      if self.deadline:
+        try:
+          conn.timeout = conn_timeout(self.opts)
+        except AttributeError:
+          # a connection of set_budget with pywbem older than 1.3, it keeps its budget
+          return
+      self.pool.put(self.opts, conn)
+
+  def set_budget(self, client, classe, left):
+    # With --timeout, limit the requests for a class to the time remaining for the 'left'
+    # classes still to fetch (this one included), less the time kept for each of the others.
+    # Returns the connection to use: the timeout of a connection can only be changed since
+    # pywbem 1.3, with older versions a new connection with the budget as timeout is opened.
+    if not self.deadline:
+      return client
+    remaining = self.deadline - time.time()
+    if remaining <= 0:
+      raise ClassTimeout("UNKNOWN: no time left for %s" % classe)
+    left = max(left, 1)
+    budget = remaining - (left - 1) * min(ClassTimeBudget, remaining / left)
+    verboseoutput("Time budget for %s: %.1fs" % (classe, budget))
+    try:
+      client.timeout = budget
+    except AttributeError:
+      import copy
+      opts = copy.copy(self.opts)
+      opts.conn_timeout = budget
+      client = new_connection(opts)
+      if self.timings is not None and hasattr(client, 'stats_enabled'):
+        client.stats_enabled = True
+    return client
+
+  # ----------------------------------------------------------------------
+
+  def run(self, prefetch=None):
+    failed = True
+    try:
+      self.collect(prefetch)
+      # nothing answered before the deadline
+      failed = bool(self.timed_out) and not self.elements
+    except CheckFailed as e:
+      self.GlobalStatus = ExitUnknown
+      self.failure = str(e)
+      failed = isinstance(e, HostUnreachable)
+      if isinstance(e, CircuitOpen):
+        failed = None
+    finally:
+      if self.stream:
+        self.stream.flush()
+      if self.opts.breaker > 0 and failed is not None:
+        breaker = host_breaker(self.opts)
+        breaker.record(self.opts, failed, self.failure or "UNKNOWN: %s" % self.ExitMsg)
+        if self.cache:
+          self.cache.set('breaker', breaker.state())
+          self.cache.save()
+    return self
+
+  # ----------------------------------------------------------------------
+
+  def prepare(self):
+    # Set up the run, returns the classes which have to be fetched from the host
+    opts = self.opts
+    if opts.breaker > 0:
+      breaker = host_breaker(opts)
+      if self.cache:
+        breaker.restore(self.cache.get('breaker'))
+      refusal = breaker.allow(opts)
+      if refusal:
+        raise CircuitOpen(refusal)
+    read_credentials(opts)
+    self.ignore = build_ignore_list(opts)
+
+    # classes the host doesn't implement or has no elements of, according to the cache
+    self.skip = self.load_capabilities()
+
+    # rarely changing classes whose last result is still recent enough
+    self.cached = self.load_results()
+
+    # if vendor is specified as 'auto', try the vendor found in an earlier run first
+    if self.vendor=='auto':
+      self.vendor = self.load_vendor()
+    return [c for c in ClassesToCheck if c not in self.skip and c not in self.cached]
+
+  def collect(self, prefetch=None):
+    # prefetch optionally holds a finished future (or asyncio future) per class, as from AsyncHostChecker
+    opts = self.opts
+    if self.ignore is None:
+      self.prepare()
+    skip = self.skip
+    cached = self.cached
+    wbemclient = self.connect()
+
+    # Fetch all classes concurrently if requested, they are evaluated in ClassesToCheck order below
+    # CIM_Chassis is left out if it is needed right away for the vendor detection
+    if prefetch is None:
+      prefetch = {}
+      if opts.parallel > 1:
+        verboseoutput("Fetching classes with %d parallel connections" % opts.parallel)
+        prefetch = collect_parallel(self, [c for c in ClassesToCheck if c not in skip and c not in cached and \
+            not (c == 'CIM_Chassis' and self.vendor == 'auto')], opts.parallel)
+
+    # if vendor is still 'auto', try to get vendor from CIM
+    # note: the default vendor is 'unknown'
+    # the chassis fetched here is evaluated in the loop below instead of being fetched again
+    chassis = None
+    if self.vendor=='auto':
+      try:
+        if 'CIM_Chassis' in prefetch:
+          chassis = fetch_instances(self.prefetched(prefetch.pop('CIM_Chassis')).result)
+        else:
+          wbemclient = self.set_budget(wbemclient, 'CIM_Chassis', len(self.to_fetch(ClassesToCheck, prefetch)))
+          with self.timer('CIM_Chassis', wbemclient):
+            chassis = fetch_instances(self.retrying, 'CIM_Chassis', enumerate_class, wbemclient, opts, 'CIM_Chassis')
+      except ClassTimeout as e:
+        # the other classes are still evaluated, as for the default vendor
+        verboseoutput("Vendor detection timed out, using vendor 'unknown': %s" % e)
+        self.timed_out.append('CIM_Chassis')
+        self.vendor = 'unknown'
+      if chassis is not None:
+        if chassis:
+          self.vendor = detect_vendor(chassis[0][u'Manufacturer'])
+        else:
+          self.vendor = 'unknown'
+
+    # Added 20121027 As long as Dell doesnt correct these CIM elements return code we have to ignore it
+    if (self.vendor == "dell" or self.vendor == "intel" or self.vendor == "ibm" or self.vendor=="unknown") :
+      self.ignore.add(dell_elements)
+
+    # run the check for each defined class
+    for i, classe in enumerate(ClassesToCheck) :
+      if classe in self.timed_out:
+        continue
+      if classe in skip:
+        verboseoutput("Skip classe %s (not implemented or empty on this host)" % classe)
+        continue
+      if classe in cached:
+        verboseoutput("Check classe %s (cached result)" % classe)
+        self.evaluate_all(classe, cached[classe])
+        continue
+      verboseoutput("Check classe "+classe)
+      errors = []
+      try:
+        if classe == 'CIM_Chassis' and chassis is not None:
+          instance_list = chassis
+        elif classe in prefetch:
+          instance_list = fetch_instances(self.prefetched(prefetch[classe]).result, errors=errors)
+        else:
+          wbemclient = self.set_budget(wbemclient, classe, len(self.to_fetch(ClassesToCheck[i:], prefetch)))
+          if opts.pull > 0 and not self.use_query(classe) and not self.needs_list(classe):
+            # instances are evaluated while they arrive, so errors can also come up halfway through
+            with self.timer(classe, wbemclient):
+              count = fetch_instances(self.evaluate_all, classe, iter_class(wbemclient, opts, classe), errors=errors)
+            self.note_capability(classe, errors, count)
+            continue
+          instance_list = fetch_instances(self.fetch_class, wbemclient, classe, errors=errors)
+      except ClassTimeout as e:
+        verboseoutput("Classe %s timed out: %s" % (classe, e))
+        self.timed_out.append(classe)
+        continue
+      if instance_list is None:
+        self.note_capability(classe, errors, None)
+        continue
+      if classe in self.queried:
+        # the query only returned elements which may be unhealthy, all others are OK
+        self.set_status(ExitOK, classe)
+      if classe in self.tiers:
+        self.results[classe] = instance_list
+      count = self.evaluate_all(classe, instance_list)
+      self.note_capability(classe, errors, count)
+      if classe == 'CIM_RecordLog' and opts.sel:
+        self.check_log_records(wbemclient, instance_list)
+    if self.capabilities is not None and not self.timed_out:
+      # only read while probing, the capabilities are probed again every --cache-ttl anyway
+      self.esxi_build = self.read_build(wbemclient)
+    self.release(wbemclient)
+    if self.timed_out:
+      self.note_timeouts()
+    if opts.history > 0 and opts.cache_dir:
+      self.record_history()
+    if self.timings is not None:
+      for classe, timing in self.timings.items():
+        verboseoutput("Timing of %s: %d requests, %d bytes, fetch %.3fs (server %.3fs), %d instances evaluated in %.3fs" \
+            % (classe, timing['requests'], timing['bytes'], timing['fetch'], timing['server'], timing['instances'], timing['evaluate']))
+    if self.cache:
+      self.save_capabilities()
+      self.save_vendor()
+      self.save_results()
+      self.cache.save()
+
+  def to_fetch(self, classes, prefetch):
+    # the classes of the given ones which still have to be fetched in the main loop
+    return [c for c in classes if c not in self.skip and c not in self.cached and c not in prefetch]
+
+  def prefetched(self, future):
+    # Waits for a class fetched by collect_parallel until the deadline at most. An asyncio
+    # future from AsyncHostChecker is always done already.
+    import concurrent.futures
+    if self.deadline and isinstance(future, concurrent.futures.Future):
+      done, pending = concurrent.futures.wait([future], timeout=max(0, self.deadline - time.time()))
+      if pending:
+        raise ClassTimeout("UNKNOWN: no result before the deadline")
+    return future
+
+  def note_timeouts(self):
+    # The status comes from the classes which were fetched in time. An alarm found there is
+    # reported as usual with the timed out classes added, otherwise the result is UNKNOWN.
+    timed_out = ", ".join(self.timed_out)
+    verboseoutput("Classes timed out: "+timed_out)
+    self.xdata['TimedOut'] = self.timed_out
+    if self.GlobalStatus == ExitWarning or self.GlobalStatus == ExitCritical:
+      self.ExitMsg += " UNKNOWN : timed out %s " % timed_out
+    else:
+      self.GlobalStatus = ExitUnknown
+      self.ExitMsg = "Execution time too long, timed out: %s" % timed_out
+
+  # ----------------------------------------------------------------------
+
+  def check_log_records(self, client, logs):
+    # Look at the records of each log (the SEL) which appeared since the last run and alert on
+    # the severe ones. The newest timestamp seen and the records carrying it are remembered
+    # per log, all older records are passed over without being evaluated.
+    # The first run of a host only takes note of the existing records.
+    # A severe record keeps alerting for --sel-hold seconds after it was found, so that the
+    # retries of a soft state see it too and the state becomes hard.
+    marks = self.cache.get('recordlog') or {}
+    now = time.time()
+    self.held_records = [held for held in self.cache.get('recordalerts') or [] if held['until'] > now]
+    for held in self.held_records:
+      verboseoutput("  Held alert until %s: %s" % (time.ctime(held['until']), held['element']))
+      self.log_record_status(held['element'], held['status'])
+    logs = [log for log in logs if not self.ignore.match(log['ElementName'] or 'Unknown') \
+        and getattr(log, 'path', None) is not None]
+    for i, log in enumerate(logs):
+      logName = log['ElementName'] or 'Unknown'
+      mark = marks.get(logName)
+      verboseoutput("  Records of log %s, known up to %s" % (logName, mark and mark['timestamp']))
+      try:
+        client = self.set_budget(client, 'CIM_LogRecord', len(logs) - i)
+        with self.timer('CIM_LogRecord', client):
+          newest = self.read_log_records(client, log, logName, mark)
+      except ClassTimeout as e:
+        verboseoutput("Records of log %s timed out: %s" % (logName, e))
+        if 'CIM_LogRecord' not in self.timed_out:
+          self.timed_out.append('CIM_LogRecord')
+        continue
+      if newest:
+        marks[logName] = newest
+    self.cache.set('recordlog', marks)
+    self.cache.set('recordalerts', self.held_records)
+
+  def read_log_records(self, client, log, logName, mark):
+    # Evaluates the new records of a log, returns the new mark of the log or None.
+    # The records are only requested while they are iterated, so errors come up in
+    # scan_log_records, which is retried as a whole before anything is evaluated.
+    scanned = fetch_instances(self.retrying, 'CIM_LogRecord', self.scan_log_records, client, log, mark)
+    if scanned is None:
+      return None
+    fresh, newest = scanned
+    for record in fresh:
+      self.evaluate_log_record(logName, record)
+    verboseoutput("    %d new records" % len(fresh))
+    return newest
+
+  def scan_log_records(self, client, log, mark):
+    # Returns the records of a log newer than the mark (none on the first run) and the new mark
+    # CIMDateTime can't be ordered, its datetime can
+    newest = mark and pywbem.CIMDateTime(mark['timestamp'])
+    newest_ids = set(mark and mark['ids'] or [])
+    fresh = []
+    for record in self.iter_log_records(client, log):
+      timestamp = record['MessageTimestamp']
+      recordId = record['RecordID']
+      if timestamp is None or timestamp.datetime is None:
+        continue
+      if newest and (timestamp.datetime < newest.datetime or \
+          (timestamp.datetime == newest.datetime and recordId in newest_ids)):
+        continue
+      if mark:
+        fresh.append(record)
+      if not newest or timestamp.datetime > newest.datetime:
+        newest, newest_ids = timestamp, set()
+      newest_ids.add(recordId)
+    if newest:
+      return fresh, {'timestamp': str(newest), 'ids': sorted(newest_ids)}
+    return fresh, None
+
+  def iter_log_records(self, client, log):
+    # the records belonging to a log, with --pull a batch at a time
+    propertylist = ['RecordID', 'MessageTimestamp', 'PerceivedSeverity', 'ElementName', 'Description', 'RecordData']
+    if hasattr(client, 'IterAssociatorInstances'):
+      return client.IterAssociatorInstances(log.path, AssocClass='CIM_LogManagesRecord', ResultClass='CIM_LogRecord',
+          IncludeQualifiers=False, IncludeClassOrigin=False, PropertyList=propertylist, MaxObjectCount=self.opts.pull or 100)
+    return client.Associators(log.path, AssocClass='CIM_LogManagesRecord', ResultClass='CIM_LogRecord',
+        IncludeQualifiers=False, IncludeClassOrigin=False, PropertyList=propertylist)
+
+  def evaluate_log_record(self, logName, record):
+    text = record['Description'] or record['ElementName'] or record['RecordData'] or record['RecordID']
+    elementStatus = record['PerceivedSeverity']
+    verboseoutput("    New record %s: %s (PerceivedSeverity = %s)" % (record['RecordID'], text, elementStatus))
+    if elementStatus is None:
+      return
+    interpretStatus = {
+      0  : ExitOK,            # Unknown
+      1  : ExitOK,            # Other
+      2  : ExitOK,            # Information
+      3  : ExitWarning,       # Degraded/Warning
+      4  : ExitWarning,       # Minor
+      5  : ExitCritical,      # Major
+      6  : ExitCritical,      # Critical
+      7  : ExitCritical       # Fatal/NonRecoverable
+    }.get(elementStatus, ExitOK)
+    element = "%s: %s" % (logName, text)
+    self.log_record_status(element, interpretStatus)
+    if interpretStatus != ExitOK and self.opts.sel_hold > 0:
+      self.held_records.append({'element': element, 'status': interpretStatus, 'until': time.time() + self.opts.sel_hold})
+
+  def log_record_status(self, element, interpretStatus):
+    self.element_classes[element] = 'CIM_LogRecord'
+    self.set_status(interpretStatus, element, element)
+    if self.stream:
+      self.stream.element('CIM_LogRecord', element, interpretStatus, None)
+
+  # ----------------------------------------------------------------------
+
+  def record_history(self):
+    # Keeps the readings of the numeric sensors (--history) and warns on too fast changes (--slope)
+    try:
+      history = SensorHistory(self.opts)
+    except (IOError, OSError, ValueError) as e:
+      verboseoutput("Cannot use sensor history: %s" % e)
+      return
+    alerts = slope_alerts(self.opts)
+    now = time.time()
+    dropped = 0
+    try:
+      history.begin(len(self.sensors))
+      for sensor in self.sensors:
+        readings = history.add(sensor.name, now, sensor.value)
+        if readings is None:
+          verboseoutput("No room in the sensor history for %s" % sensor.name)
+          dropped += 1
+          continue
+        for sensorType, change, seconds in alerts:
+          if sensor.sensor_type != sensorType:
+            continue
+          window = [value for t, value in readings if now - t <= seconds]
+          if change > 0:
+            changed = sensor.value - min(window)
+          else:
+            changed = sensor.value - max(window)
+          verboseoutput("  %s changed by %g within %g minutes" % (sensor.name, changed, seconds / 60))
+          if changed != 0 and changed / change >= 1:
+            self.set_status(ExitWarning, "%s: %s by %g within %g minutes" \
+                % (sensor.name, 'rose' if change > 0 else 'fell', abs(changed), seconds / 60), sensor.name)
+    finally:
+      history.close()
+    if dropped:
+      self.set_status(ExitWarning, "Sensor history: no room for %d sensors" % dropped)
+
+  # ----------------------------------------------------------------------
+
+  def load_results(self):
+    # Returns the cached instances of each class with a refresh interval which hasn't expired yet
+    cached = {}
+    stored = self.cache and self.cache.get('results') or {}
+    for classe, interval in self.tiers.items():
+      if classe in stored and time.time() - stored[classe]['time'] < interval:
+        cached[classe] = [CachedInstance(i) for i in stored[classe]['instances']]
+    return cached
+
+  def save_results(self):
+    stored = self.cache.get('results') or {}
+    for classe, instance_list in self.results.items():
+      stored[classe] = {'time': time.time(),
+                        'instances': [dict((k, cache_value(v)) for k, v in i.items()) for i in instance_list]}
+    if stored:
+      self.cache.set('results', stored)
+
+  # ----------------------------------------------------------------------
+
+  def load_capabilities(self):
+    # Returns the classes to skip according to the capability cache. Without a valid
+    # cache entry all classes are probed in this run and the result is kept.
+    if not self.cache:
+      return set()
+    caps = self.cache.get('classes')
+    if caps and time.time() - caps['created'] < self.opts.cache_ttl:
+      self.no_query = set(caps.get('noquery', []))
+      return set(caps['missing'] + caps['empty'])
+    verboseoutput("Probing which classes this host implements")
+    self.capabilities = {'created': time.time(), 'missing': [], 'empty': [], 'noquery': []}
+    return set()
+
+  def note_capability(self, classe, errors, count):
+    if self.capabilities is None:
+      return
+    if any(e.args[0] in CIM_ERR_CLASS_MISSING for e in errors):
+      self.capabilities['missing'].append(classe)
+    elif count == 0 and classe not in self.queried:
+      # a query without results only means all elements are OK
+      self.capabilities['empty'].append(classe)
+
+  def read_build(self, client):
+    # Returns the version and build of ESXi, or None if the host doesn't tell
+    for classe in BuildClasses:
+      try:
+        client = self.set_budget(client, classe, 1)
+        with self.timer(classe, client):
+          instance_list = fetch_instances(self.retrying, classe,
+              lambda: client.EnumerateInstances(classe, PropertyList=BuildProperties))
+      except CheckFailed as e:
+        verboseoutput("No ESXi build from %s: %s" % (classe, e))
+        return None
+      for instance in instance_list or []:
+        name = instance.get('ElementName') or instance.get('Name') or ''
+        version = instance.get('VersionString') or instance.get('Version')
+        if 'ESX' in name and version:
+          verboseoutput("ESXi build: %s %s" % (name, version))
+          return "%s %s" % (name, version)
+    return None
+
+  def save_capabilities(self):
+    caps = self.cache.get('classes')
+    if self.capabilities is not None:
+      # the firmware identifies the host's provider set, a change invalidates the entry.
+      # The ESXi build is only read while probing, so it tells which build the entry is for.
+      self.capabilities['signature'] = self.bios_info
+      self.capabilities['build'] = self.esxi_build
+      self.capabilities['noquery'] = sorted(self.no_query)
+      self.cache.set('classes', self.capabilities)
+    elif caps and self.bios_info and caps.get('signature') and caps['signature'] != self.bios_info:
+      verboseoutput("Firmware has changed, probing classes again next time")
+      self.cache.remove('classes')
+    elif caps and self.no_query_found:
+      caps['noquery'] = sorted(self.no_query)
+      self.cache.set('classes', caps)
+
+  # ----------------------------------------------------------------------
+
+  def load_vendor(self):
+    # Returns the vendor detected in an earlier run, or 'auto' if it has to be detected now
+    cached = self.cache and self.cache.get('vendor')
+    if cached and time.time() - cached['created'] < self.opts.cache_ttl:
+      verboseoutput("Using cached vendor "+cached['vendor'])
+      return cached['vendor']
+    return 'auto'
+
+  def save_vendor(self):
+    # Every run sees the chassis anyway, so the cached vendor is renewed from it without an extra
+    # request. The serial number tells whether this is still the same machine.
+    if self.opts.vendor != 'auto' or self.chassis_manufacturer is None:
+      return
+    cached = self.cache.get('vendor')
+    vendor = detect_vendor(self.chassis_manufacturer)
+    if cached and (cached['serial'] != self.chassis_serial or cached['vendor'] != vendor):
+      verboseoutput("Chassis has changed (s/n %s, vendor %s), cached vendor replaced" % (self.chassis_serial, vendor))
+    self.cache.set('vendor', {'vendor': vendor, 'serial': self.chassis_serial, 'created': time.time()})
+
+  # ----------------------------------------------------------------------
+
+  def needs_list(self, classe):
+    # the complete list of instances is kept for later runs or looked at once more after evaluation
+    return classe in self.tiers or (classe == 'CIM_RecordLog' and self.opts.sel)
+
+  def use_query(self, classe):
+    if not self.opts.fast_health or not self.query_supported or classe in self.no_query:
+      return False
+    # the query selects on HealthState, which is where the status comes from for HP only,
+    # OperationalStatus is an array and can't be compared reliably in WQL
+    if self.vendor != 'hp':
+      return False
+    if self.needs_list(classe):
+      return False
+    if classe in FastHealthFullClasses:
+      return False
+    # all sensors are needed for the performance data, the history and the exporter
+    return not (classe == 'CIM_NumericSensor' and self.needs_readings())
+
+  def needs_readings(self):
+    opts = self.opts
+    return bool(opts.perfdata or opts.history > 0 or opts.exporter)
+
+  def fetch_class(self, client, classe):
+    with self.timer(classe, client):
+      return self.retrying(classe, self.fetch_class_once, client, classe)
+
+  def fetch_class_once(self, client, classe):
+    # Get the instances of a class to evaluate. With --fast-health this is only the ones which
+    # may not be OK, falling back to all of them if the CIM server can't run the query.
+    if self.use_query(classe):
+      instance_list = self.query_unhealthy(client, classe)
+      if instance_list is not None:
+        self.queried.add(classe)
+        return instance_list
+    return enumerate_class(client, self.opts, classe)
+
+  def retrying(self, classe, fetch, *args):
+    # Call fetch(*args) within the limit of concurrent requests to the host (--host-limit) and
+    # retry it up to --retries times after transient errors of an overloaded CIM server, waiting
+    # a jittered, exponentially growing delay. No retry is started which would end after the deadline.
+    attempt = 0
+    while True:
+      try:
+        with self.host_slot(classe):
+          return fetch(*args)
+      except (PywbemCimOperations.CIMError, PywbemExceptions.ConnectionError) as e:
+        if attempt >= self.opts.retries or not transient_error(e):
+          raise
+        import random
+        delay = self.opts.retry_delay * 2 ** attempt * random.uniform(0.5, 1.5)
+        if self.deadline and time.time() + delay >= self.deadline:
+          raise
+        attempt += 1
+        verboseoutput("Transient error on %s, retry %d in %.1fs: %s" % (classe, attempt, delay, e))
+        time.sleep(delay)
+
+  @contextlib.contextmanager
+  def host_slot(self, classe):
+    # Waits for one of the --host-limit request slots of the host, until the deadline at most
+    if self.opts.host_limit <= 0:
+      yield
+      return
+    limiter = host_limiter(self.opts)
+    timeout = None
+    if self.deadline:
+      timeout = max(0, self.deadline - time.time())
+    if not limiter.acquire(timeout=timeout):
+      raise ClassTimeout("UNKNOWN: no request slot for %s before the deadline" % classe)
+    try:
+      yield
+    finally:
+      limiter.release()
+
+  def query_unhealthy(self, client, classe):
+    # Returns the elements of a class which are not reported as OK, or None if the query failed
+    propertylist = class_propertylist(self.opts, classe)
+    if propertylist:
+      select = ", ".join(propertylist)
+    else:
+      select = "*"
+    query = "SELECT %s FROM %s WHERE HealthState <> 5" % (select, classe)
+    try:
+      return client.ExecQuery('WQL', query)
+    except (PywbemCimOperations.CIMError, PywbemExceptions.ConnectionError) as args:
+      verboseoutput("Query on %s failed, enumerating all elements: %s" % (classe, args))
+      # the class is enumerated from now on, until the capabilities are probed again
+      self.no_query.add(classe)
+      self.no_query_found = True
+      # no use trying the other classes if the server can't do queries at all
+      if isinstance(args, PywbemCimOperations.CIMError) and \
+          args.args[0] in (CIM_ERR_NOT_SUPPORTED, CIM_ERR_QUERY_LANGUAGE_NOT_SUPPORTED):
+        self.query_supported = False
+        self.no_query.update(ClassesToCheck)
+      return None
+
+  # ----------------------------------------------------------------------
+
+  def evaluate_all(self, classe, instances):
+    count = 0
+    if self.timings is not None:
+      timing = self.timing(classe)
+      for instance in instances :
+        start = time.perf_counter()
+        self.evaluate(classe, instance)
+        timing['evaluate'] += time.perf_counter() - start
+        count += 1
+      timing['instances'] += count
+      if self.stream:
+        self.stream.flush()
+      return count
+    for instance in instances :
+      self.evaluate(classe, instance)
+      count += 1
+    if self.stream:
+      self.stream.flush()
+    return count
+
+  # ----------------------------------------------------------------------
+
+  def timing(self, classe):
+    return self.timings.setdefault(classe, {'requests': 0, 'bytes': 0, 'fetch': 0.0, 'server': 0.0,
+        'instances': 0, 'evaluate': 0.0})
+
+  @contextlib.contextmanager
+  def timer(self, classe, client):
+    # Adds the time and requests of fetching a class to its timings (--timings). Instances
+    # evaluated while they arrive (--pull) don't count towards the fetch time.
+    if self.timings is None:
+      yield
+      return
+    timing = self.timing(classe)
+    requests, received, server = connection_stats(client)
+    evaluate = timing['evaluate']
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      timing['fetch'] += time.perf_counter() - start - (timing['evaluate'] - evaluate)
+      after = connection_stats(client)
+      timing['requests'] += after[0] - requests
+      timing['bytes'] += int(after[1] - received)
+      timing['server'] += after[2] - server
+
+  # ----------------------------------------------------------------------
+
+  def set_status(self, interpretStatus, elementNameValue, elementName=None):
+    if elementName is not None:
+      self.elements[elementName] = max(interpretStatus, self.elements.get(elementName, ExitOK))
+    if (interpretStatus == ExitCritical) :
+      verboseoutput("Global exit set to CRITICAL")
+      self.GlobalStatus = ExitCritical
+      self.ExitMsg += " CRITICAL : %s " % elementNameValue
+    if (interpretStatus == ExitWarning and self.GlobalStatus != ExitCritical) :
+      verboseoutput("Global exit set to WARNING")
+      self.GlobalStatus = ExitWarning
+      self.ExitMsg += " WARNING : %s " % elementNameValue
+    # Added the following for when GlobalStatus is ExitCritical and a warning is detected
+    # This way the ExitMsg gets added but GlobalStatus isn't changed
+    if (interpretStatus == ExitWarning and self.GlobalStatus == ExitCritical) : # ARR
+      self.ExitMsg += " WARNING : %s " % elementNameValue #ARR
+    # Added the following so that GlobalStatus gets set to OK if there's no warning or critical
+    if (interpretStatus == ExitOK and self.GlobalStatus != ExitWarning and self.GlobalStatus != ExitCritical) : #ARR
+      self.GlobalStatus = ExitOK #ARR
+
+  # ----------------------------------------------------------------------
+
+  def evaluate(self, classe, instance):
+    vendor = self.vendor
+    if classe == 'CIM_Chassis' and self.chassis_manufacturer is None:
+      # the first chassis identifies the vendor, as in the detection with '-V auto'
+      self.chassis_manufacturer = instance[u'Manufacturer'] or ''
+      self.chassis_serial = instance[u'SerialNumber']
+    elementName = instance['ElementName']
+    if elementName is None :
+      elementName = 'Unknown'
+    elementNameValue = elementName
+    sensor = None
+    interpretStatus = None
+    verboseoutput("  Element Name = "+elementName)
+
+    # Ignore element if we don't want it
+    ignored = self.ignore.match(elementName)
+    if ignored :
+      if ignored == 'regex' :
+        verboseoutput("    (ignored through regex)")
+      verboseoutput("    (ignored)")
+      return
+    self.element_classes[elementName] = classe
+
+    # BIOS & Server info
+    if elementName == 'System BIOS' :
+      self.bios_info =     instance[u'Name'] + ': ' \
+          + instance[u'VersionString'] + ' ' \
+          + str(instance[u'ReleaseDate'].datetime.date())
+      verboseoutput("    VersionString = "+instance[u'VersionString'])
+
+      self.xdata['Bios Info'] = self.bios_info
+
+    elif elementName == 'Chassis' :
+      man = instance[u'Manufacturer']
+      if man is None :
+        man = 'Unknown Manufacturer'
+      verboseoutput("    Manufacturer = "+man)
+      self.SerialNumber = instance[u'SerialNumber']
+      self.SerialChassis = instance[u'SerialNumber']
+      if self.SerialNumber:
+        verboseoutput("    SerialNumber = "+self.SerialNumber)
+      self.server_info = man + ' '
+      if vendor != 'intel':
+        model = instance[u'Model']
+        if model:
+          verboseoutput("    Model = "+model)
+          self.server_info +=  model
+
+    elif elementName == 'Server Blade' :
+      self.SerialNumber = instance[u'SerialNumber']
+      if self.SerialNumber:
+        verboseoutput("    SerialNumber = "+self.SerialNumber)
+        self.isblade = "yes"
+
+    self.xdata['SerialNumber'] = self.SerialNumber
+
+    # Report detail of Numeric Sensors and generate nagios perfdata
+
+    if classe == "CIM_NumericSensor" :
+      sensorType = instance[u'sensorType']
+      sensStr = sensor_Type.get(sensorType,"Unknown")
+      if sensorType:
+        verboseoutput("    sensorType = %d - %s" % (sensorType,sensStr))
+      units = instance[u'BaseUnits']
+      if units:
+        verboseoutput("    BaseUnits = %d" % units)
+      # grab some of these values for Nagios performance data
+      scale = 10**instance[u'UnitModifier']
+      verboseoutput("    Scaled by = %f " % scale)
+      cr = int(instance[u'CurrentReading'])*scale
+      verboseoutput("    Current Reading = %f" % cr)
+      elementNameValue = "%s: %g" % (elementName,cr)
+      ltnc = 0
+      utnc = 0
+      ltc  = 0
+      utc  = 0
+      if instance[u'LowerThresholdNonCritical'] is not None:
+        ltnc = instance[u'LowerThresholdNonCritical']*scale
+        verboseoutput("    Lower Threshold Non Critical = %f" % ltnc)
+      if instance[u'UpperThresholdNonCritical'] is not None:
+        utnc = instance[u'UpperThresholdNonCritical']*scale
+        verboseoutput("    Upper Threshold Non Critical = %f" % utnc)
+      if instance[u'LowerThresholdCritical'] is not None:
+        ltc = instance[u'LowerThresholdCritical']*scale
+        verboseoutput("    Lower Threshold Critical = %f" % ltc)
+      if instance[u'UpperThresholdCritical'] is not None:
+        utc = instance[u'UpperThresholdCritical']*scale
+        verboseoutput("    Upper Threshold Critical = %f" % utc)
+      sensor = SensorReading(elementName, sensorType, units, cr, ltnc, utnc, ltc, utc)
+      self.sensors.append(sensor)
+
+    elif classe == "CIM_Processor" :
+      verboseoutput("    Family = %d" % instance['Family'])
+      verboseoutput("    CurrentClockSpeed = %dMHz" % instance['CurrentClockSpeed'])
+
+    # HP Check
+    if vendor == "hp" :
+      if instance['HealthState'] is not None :
+        elementStatus = instance['HealthState']
+        verboseoutput("    Element HealthState = %d" % elementStatus)
+        interpretStatus = {
+          0  : ExitOK,    # Unknown
+          5  : ExitOK,    # OK
+          10 : ExitWarning,  # Degraded
+          15 : ExitWarning,  # Minor
+          20 : ExitCritical,  # Major
+          25 : ExitCritical,  # Critical
+          30 : ExitCritical,  # Non-recoverable Error
+        }[elementStatus]
+        self.set_status(interpretStatus, elementNameValue, elementName)
+        if sensor:
+          sensor.status = interpretStatus
+
+    # Dell, Intel, IBM and unknown hardware check
+    elif (vendor == "dell" or vendor == "intel" or vendor == "ibm" or vendor=="unknown") :
+      if instance['OperationalStatus'] is not None :
+        elementStatus = instance['OperationalStatus'][0]
+        verboseoutput("    Element Op Status = %d" % elementStatus)
+        interpretStatus = {
+          0  : ExitOK,            # Unknown
+          1  : ExitCritical,      # Other
+          2  : ExitOK,            # OK
+          3  : ExitWarning,       # Degraded
+          4  : ExitWarning,       # Stressed
+          5  : ExitWarning,       # Predictive Failure
+          6  : ExitCritical,      # Error
+          7  : ExitCritical,      # Non-Recoverable Error
+          8  : ExitWarning,       # Starting
+          9  : ExitWarning,       # Stopping
+          10 : ExitCritical,      # Stopped
+          11 : ExitOK,            # In Service
+          12 : ExitWarning,       # No Contact
+          13 : ExitCritical,      # Lost Communication
+          14 : ExitCritical,      # Aborted
+          15 : ExitOK,            # Dormant
+          16 : ExitCritical,      # Supporting Entity in Error
+          17 : ExitOK,            # Completed
+          18 : ExitOK,            # Power Mode
+          19 : ExitOK,            # DMTF Reserved
+          20 : ExitOK             # Vendor Reserved
+        }[elementStatus]
+        self.set_status(interpretStatus, elementNameValue, elementName)
+        if sensor:
+          sensor.status = interpretStatus
+      if elementName == 'Server Blade' :
+              if self.SerialNumber :
+                      if self.SerialNumber.find(".") != -1 :
+                              self.SerialNumber = self.SerialNumber.split('.')[1]
+
+    if self.stream:
+      self.stream.element(classe, elementName, interpretStatus, sensor)
+
+  # ----------------------------------------------------------------------
+
+  def result(self):
+    # Returns the outcome of this check as CheckResult
+    return CheckResult(self)
+
+  # ----------------------------------------------------------------------
+
+  def output(self):
+    # Returns the plugin output line for this check
+    text, perf = self.format()
+    if self.opts.format == 'json' and not self.failure:
+      return xdataprint(self.opts, self.xdata)
+    if self.opts.format in StreamFormats:
+      return stream_summary(self.opts, self.GlobalStatus, text)
+    return plugin_output(text, perf)
+
+  def format(self):
+    # Returns the plugin output text and the performance data of this check, also
+    # fills xdata for --format json
+    opts = self.opts
+    if self.failure:
+      return self.failure, ''
+
+    SerialNumber = self.SerialNumber
+    server_info = self.server_info
+
+    # Munge the ouptput to give links to documentation and warranty info
+    if (opts.urlise_country != '') :
+      SerialNumber = urlised_serialnumber(self.vendor,opts.urlise_country,SerialNumber)
+      server_info = urlised_server_info(self.vendor,opts.urlise_country,server_info)
+
+    # If this is a blade server, also output chassis serial number as additional info
+    if (self.isblade == "yes") :
+      SerialNumber += " Chassis S/N: %s " % (self.SerialChassis)
+      self.xdata['ChassisSerialNumber'] = self.SerialChassis
+
+    # Output performance data
+    perf = ''
+    if opts.perfdata:
+      data = []
+      for sensor in self.sensors:
+        perfgroup = sensor.perfgroup(opts)
+        if perfgroup is None:
+          continue
+        group, unit = perfgroup
+        perf_el = sensor.name.replace(' ','_')
+        if group == 6:
+          data.append( ("%s=%g%%;%g;%g " % (perf_el, sensor.value, sensor.upper_warn, sensor.upper_crit),group) )
+        else:
+          data.append( ("%s=%g;%g;%g " % (perf_el, sensor.value, sensor.upper_warn, sensor.upper_crit),group) )
+        self.xdata[perf_el] = { 'Value': sensor.value, 'warn' : sensor.upper_warn, 'crit': sensor.upper_crit }
+        if unit:
+          self.xdata[perf_el]['Unit'] = unit
+      sdata=[]
+      ctr=[0,0,0,0,0,0,0]
+      # sort the data so we always get perfdata in the right order
+      # we make no assumptions about the order in which CIM returns data
+      # first sort by element name (effectively) and insert sequence numbers
+      for p in sorted(data):
+        p1 = p[1]
+        sdata.append( ("P%d%s_%d_%s") % (p1,perf_Prefix[p1], ctr[p1], p[0]) )
+        ctr[p1] += 1
+      # then sort perfdata into groups and output perfdata string
+      for p in sorted(sdata):
+        perf += p
+
+    # time spent fetching each class (--timings)
+    if self.timings:
+      for classe, timing in sorted(self.timings.items()):
+        perf += "cim_time_%s=%.3fs cim_bytes_%s=%dB " % (classe, timing['fetch'], classe, timing['bytes'])
+      self.xdata['Timings'] = self.timings
+
+    self.xdata['GlobalStatus'] = self.GlobalStatus
+
+    if self.GlobalStatus == ExitOK :
+      return "OK - Server: %s s/n: %s %s" % (server_info, SerialNumber, self.bios_info), perf
+    elif self.GlobalStatus == ExitUnknown :
+      return "UNKNOWN: %s" % (self.ExitMsg), '' #ARR
+    else:
+      return "%s - Server:  %s %s %s" % (self.ExitMsg, server_info, 's/n: ' + SerialNumber, self.bios_info), perf
 
-  # if user or password starts with 'file:', use the first string in file as user, second as password
-  if (re.match('^file:', user) or re.match('^file:', password)):
-        if re.match('^file:', user):
-          filextract = re.sub('^file:', '', user)
-          filename = open(filextract, 'r')
-          filetext = filename.readline().split()
-          user = filetext[0]
-          password = filetext[1]
-          filename.close()
-        elif re.match('^file:', password):
-          filextract = re.sub('^file:', '', password)
-          filename = open(filextract, 'r')
-          filetext = filename.readline().split()
-          password = filetext[0]
-          filename.close()
+# ----------------------------------------------------------------------
+
+def plugin_output(text, perf):
+  # The plugin output line, performance data follow the text after '|' if there are any
+  if perf:
+    return "%s|%s" % (text, perf)
+  return text
 
 # ----------------------------------------------------------------------
 
-getopts()
+# output formats writing a record per element while the check runs
+StreamFormats = ['ndjson', 'influx']
 
-# if running on Windows, don't use timeouts and signal.alarm
-on_windows = True
-os_platform = sys.platform
-if os_platform != "win32":
-  on_windows = False
-  import signal
-  def handler(signum, frame):
-    print('UNKNOWN: Execution time too long!')
-    sys.exit(ExitUnknown)
+def influx_key(value):
+  # escapes a measurement name, tag key or tag value of the line protocol
+  return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ').replace('\n', '\\n')
+
+def influx_fields(fields):
+  parts = []
+  for k, v in fields.items():
+    if isinstance(v, str):
+      v = '"%s"' % v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    elif isinstance(v, int):
+      v = '%di' % v
+    else:
+      v = repr(float(v))
+    parts.append('%s=%s' % (influx_key(k), v))
+  return ','.join(parts)
+
+def stream_record(opts, measurement, tags, fields):
+  # One record of --format ndjson or influx, with a timestamp in nanoseconds
+  import json
+  now = time.time_ns()
+  if opts.format == 'ndjson':
+    record = {'time': now, 'measurement': measurement}
+    record.update(tags)
+    record.update(fields)
+    return json.dumps(record)
+  tags = ''.join(',%s=%s' % (influx_key(k), influx_key(v)) for k, v in tags.items() if v != '')
+  return "%s%s %s %d" % (influx_key(measurement), tags, influx_fields(fields), now)
+
+def stream_summary(opts, status, text):
+  # the record closing the output of a check
+  return stream_record(opts, 'esxi_check', {'host': opts.hostname or opts.hosturl}, {'status': status, 'output': text})
+
+class RecordStream:
+  # Writes a record for each evaluated element to stdout as soon as it is evaluated
+  # (--format ndjson or influx): host, class and element, the status if the element has one and,
+  # for numeric sensors, the reading, type, unit and the thresholds which are set.
+  # The lock keeps the lines of checks running concurrently (--hostlist) apart.
+  lock = threading.Lock()
+
+  def __init__(self, opts):
+    self.opts = opts
+    self.host = opts.hostname or opts.hosturl
+    self.lines = []
+
+  def element(self, classe, elementName, status, sensor):
+    tags = {'host': self.host, 'class': classe, 'element': elementName}
+    fields = {}
+    if status is not None:
+      fields['status'] = status
+    if sensor is not None:
+      tags['type'] = sensor_Type.get(sensor.sensor_type, "Unknown")
+      tags['unit'] = sensor_Units.get(sensor.units, "unknown")
+      fields['reading'] = float(sensor.value)
+      for threshold in ('lower_warn', 'upper_warn', 'lower_crit', 'upper_crit'):
+        if getattr(sensor, threshold):
+          fields[threshold] = float(getattr(sensor, threshold))
+    if not fields and self.opts.format == 'influx':
+      # a line without fields is invalid
+      return
+    self.lines.append(stream_record(self.opts, 'esxi_element', tags, fields))
+
+  def flush(self):
+    # called once per class, so that a consumer gets the records of a class at once
+    if not self.lines:
+      return
+    lines, self.lines = self.lines, []
+    with self.lock:
+      sys.stdout.write("\n".join(lines) + "\n")
+      sys.stdout.flush()
+
+# ----------------------------------------------------------------------
+
+class CheckResult:
+  # Outcome of a check for callers using this file as a library (see check_host):
+  #   status      - ExitOK, ExitWarning, ExitCritical or ExitUnknown
+  #   output      - the plugin output line
+  #   error       - the reason of an UNKNOWN status if the check could not be completed, else None
+  #   elements    - dict of element name to its status, for every element which reported one
+  #   sensors     - list of SensorReading with name, sensor type, units, value, thresholds and status
+  #   server, serial, chassis_serial, bios, vendor - what the host told about itself
+  #   timings     - dict of class to its requests, bytes, fetch/server/evaluate time and instances,
+  #                 with timings=True, else None
+
+  status_names = {ExitOK: 'OK', ExitWarning: 'WARNING', ExitCritical: 'CRITICAL', ExitUnknown: 'UNKNOWN'}
+
+  def __init__(self, check):
+    self.host = check.opts.hostname
+    self.status = check.GlobalStatus
+    self.output = check.output()
+    self.error = check.failure
+    self.elements = check.elements
+    self.sensors = check.sensors
+    self.server = check.server_info.strip()
+    self.serial = check.SerialNumber
+    self.chassis_serial = check.SerialChassis if check.isblade == "yes" else None
+    self.bios = check.bios_info
+    self.vendor = check.vendor
+    self.timings = check.timings
+
+  @property
+  def status_name(self):
+    return self.status_names[self.status]
+
+  def problems(self):
+    # the elements which are not OK, worst first
+    return sorted(((name, status) for name, status in self.elements.items() if status != ExitOK),
+        key=lambda e: (-e[1], e[0]))
+
+  def as_dict(self):
+    d = dict(vars(self))
+    d['status_name'] = self.status_name
+    d['sensors'] = [sensor.as_dict() for sensor in self.sensors]
+    return d
+
+  def __repr__(self):
+    return "<CheckResult %s %s>" % (self.host, self.status_name)
+
+# ----------------------------------------------------------------------
 
-# Use non-default CIM port
-if cimport:
-  verboseoutput("Using manually defined CIM port "+cimport)
-  hosturl += ':'+cimport
-
-# Use non-default SSL protocol version
-if sslproto:
-  verboseoutput("Using non-default SSL protocol: "+sslproto)
-  allowed_protos = ["SSLv2", "SSLv3", "TLSv1", "TLSv1.1", "TLSv1.2", "TLSv1.3"]
-  if any(proto.lower() == sslproto.lower() for proto in allowed_protos):
-    import os
-    sslconfpath = '/tmp/'+hostname+'_openssl.conf'
-    verboseoutput("Creating OpenSSL config file: "+sslconfpath)
+def check_options(host, user, password, **kwargs):
+  # The options of a check as the command line would give them, e.g.
+  # check_options('esx01', 'root', 'secret', vendor='auto', perfdata=True, ignore='DIMM A1')
+  # Keyword arguments are named like the attributes of getopts() (see the dest of each option).
+  # The timeout applies to each CIM request as signal.alarm can't be used in a library,
+  # and --sslproto is not available as it changes the environment of the whole process.
+  opts = option_parser().get_default_values()
+  for key, value in kwargs.items():
+    if not hasattr(opts, key) or key in daemon_local_options:
+      raise TypeError("unknown check option '%s'" % key)
+    setattr(opts, key, value)
+  opts.user = user
+  opts.password = password
+  set_host(opts, host)
+  opts.urlise_country = opts.urlise_country.lower()
+  opts.vendor = opts.vendor.lower()
+  opts.parallel = max(1, opts.parallel)
+  opts.conn_timeout = opts.timeout if opts.timeout > 0 else None
+  if opts.cimport:
+    opts.cimport = str(opts.cimport)
+  return opts
+
+# ----------------------------------------------------------------------
+
+class HostChecker:
+  # Checks hosts in-process and keeps their connections open for the next check of
+  # the same host, e.g. for a collector checking many hosts over and over:
+  #   checker = HostChecker(user='root', password='file:/etc/esx', vendor='auto')
+  #   result = checker.check('esx01.example.com')
+  # Arguments given to check() override the ones given here.
+
+  def __init__(self, **defaults):
+    self.defaults = defaults
+    self.pool = ConnectionPool()
+
+  def check(self, host, **kwargs):
+    args = dict(self.defaults, **kwargs)
+    opts = check_options(host, args.pop('user', None), args.pop('password', None), **args)
+    status, output, check = check_hostopts(opts, self.pool)
+    return check.result()
+
+def check_host(host, user, password, **kwargs):
+  # Check one host and return its CheckResult, takes the same arguments as check_options()
+  status, output, check = check_hostopts(check_options(host, user, password, **kwargs))
+  return check.result()
+
+# ----------------------------------------------------------------------
+
+class AsyncHostChecker:
+  # Checks many hosts from one asyncio event loop, e.g. thousands of hosts from one collector:
+  #   checker = AsyncHostChecker(limit=200, host_limit=4, user='root', password='file:/etc/esx')
+  #   results = await asyncio.gather(*(checker.check(host) for host in hosts))
+  # The classes of all hosts are fetched concurrently, with at most 'limit' CIM requests
+  # in flight overall and 'host_limit' per host. pywbem itself is blocking, so the requests
+  # run on a pool of 'limit' threads: the number of threads depends on the limit, not on the
+  # number of hosts. Once all classes of a host are there, it is evaluated by HostCheck as usual.
+
+  def __init__(self, limit=100, host_limit=4, **defaults):
+    import concurrent.futures
+    self.limit = limit
+    self.host_limit = host_limit
+    self.defaults = defaults
+    self.pool = ConnectionPool()
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=limit)
+    self.semaphore = None
+
+  async def check(self, host, **kwargs):
+    # Check one host and return its CheckResult, arguments as for HostChecker.check()
+    args = dict(self.defaults, **kwargs)
+    opts = check_options(host, args.pop('user', None), args.pop('password', None), **args)
+    check = await self.run_check(opts)
+    return check.result()
+
+  async def run_check(self, opts):
+    # Check one host given by its options, returns the HostCheck
+    import asyncio
+    loop = asyncio.get_running_loop()
+    if self.semaphore is None:
+      self.semaphore = asyncio.Semaphore(self.limit)
+    check = new_check(opts, self.pool)
     try:
-      with open(sslconfpath, 'w') as config_file:
-          config_file.write("openssl_conf = openssl_init\n[openssl_init]\nssl_conf = ssl_configuration\n[ssl_configuration]\nsystem_default = tls_system_default\n[tls_system_default]\nMinProtocol = "+sslproto+"\n")
-    except Exception as e:
-      print('CRITICAL: An error occured while trying to write ssl config file: %s (%s)' % (sslconfpath, e))
-      sys.exit(ExitCritical)
-    os.environ["OPENSSL_CONF"] = sslconfpath
+      classes = check.prepare()
+    except CheckFailed as e:
+      check.failure = str(e)
+      return check
+
+    queue = list(classes)
+    prefetch = dict((classe, loop.create_future()) for classe in classes)
+
+    async def fetch_queued():
+      while queue:
+        classe = queue.pop(0)
+        verboseoutput("Fetching classe %s of %s" % (classe, opts.hostname))
+        # the classes still to come share the time left with this one (--timeout)
+        rounds = len(queue) // self.host_limit + 1
+        try:
+          prefetch[classe].set_result(await loop.run_in_executor(self.executor, self.fetch_class, check, classe, rounds))
+        except Exception as e:
+          prefetch[classe].set_exception(e)
+
+    async def helper(busy):
+      async with self.semaphore:
+        busy.append(True)
+        await fetch_queued()
+
+    # A host holds one request slot until it has been evaluated (which may still ask for log
+    # records with --sel) and up to host_limit - 1 more while classes are left. So the hosts
+    # which got a slot first are finished first, rather than all hosts advancing by a class at
+    # a time, and --timeout only starts once a host has a slot.
+    async with self.semaphore:
+      check.start_deadline()
+      helpers = []
+      for i in range(min(self.host_limit, len(classes)) - 1):
+        busy = []
+        helpers.append((busy, loop.create_task(helper(busy))))
+      await fetch_queued()
+      for busy, task in helpers:
+        if not busy:
+          task.cancel()
+      await asyncio.gather(*(task for busy, task in helpers), return_exceptions=True)
+      # mark failures as seen, the ones of classes not evaluated after an early UNKNOWN would be logged
+      for future in prefetch.values():
+        future.exception()
+      return await loop.run_in_executor(self.executor, check.run, prefetch)
+
+  def fetch_class(self, check, classe, rounds):
+    client = check.connect()
+    client = check.set_budget(client, classe, rounds)
+    instance_list = check.fetch_class(client, classe)
+    check.release(client)
+    return instance_list
+
+# ----------------------------------------------------------------------
+
+def read_hostlist(opts, hostlist):
+  # Each line holds a host name, optionally followed by key=value overrides of the
+  # command line options, e.g. "esx01.example.com user=root password=file:/etc/esx01 vendor=hp"
+  # Empty lines and lines starting with '#' are skipped.
+  import copy
+  overrides = {'user': 'user', 'password': 'password', 'cimport': 'cimport', 'vendor': 'vendor', 'ignore': 'ignore',
+      'service': 'service', 'hostname': 'passive_host'}
+  if hostlist == '-':
+    f = sys.stdin
   else:
-    print('CRITICAL: Invalid SSL protocol version given!')
-    sys.exit(ExitCritical)
-
-# Append lcd related elements to ignore list if --no-lcd was used
-verboseoutput("LCD Status: %s" % get_lcd)
-if not get_lcd:
-  ignore_list.append("System Board 1 LCD Cable Pres 0: Connected")
-  ignore_list.append("System Board 1 VGA Cable Pres 0: Connected")
-  ignore_list.append("Front Panel Board 1 FP LCD Cable 0: Connected")
-  ignore_list.append("Front Panel Board 1 FP LCD Cable 0: Config Error")
-
-# Append chassis intrusion related elements to ignore list if --no-intrusion was used
-verboseoutput("Chassis Intrusion Status: %s" % get_intrusion)
-if not get_intrusion:
-  ignore_list.append("System Chassis 1 Chassis Intru: General Chassis intrusion")
-  ignore_list.append("System Chassis 1 Chassis Intru: Drive Bay intrusion")
-  ignore_list.append("System Chassis 1 Chassis Intru: I/O Card area intrusion")
-  ignore_list.append("System Chassis 1 Chassis Intru: Processor area intrusion")
-  ignore_list.append("System Chassis 1 Chassis Intru: System unplugged from LAN")
-  ignore_list.append("System Chassis 1 Chassis Intru: Unauthorized dock")
-  ignore_list.append("System Chassis 1 Chassis Intru: FAN area intrusion")
-  ignore_list.append("System Chassis 1 Chassis Intru: Unknown")
-
-# connection to host
-pywbemversion = pywbem.__version__
-verboseoutput("Found pywbem version "+pywbemversion)
-verboseoutput("Connection to "+hosturl)
-wbemclient = pywbem.WBEMConnection(hosturl, (user,password), NS, no_verification=True)
-
-# Backward compatibility for older pywbem exceptions, big thanks to Claire M.!
-if Version(pywbemversion) >= Version("1.0.0"):
-  verboseoutput("pywbem is 1.0.0 or newer")
-  import pywbem._cim_operations as PywbemCimOperations
-  import pywbem._cim_http as PywbemCimHttp
-  import pywbem._exceptions as PywbemExceptions
-else:
-  verboseoutput("pywbem is older than 1.0.0")
-  import pywbem.cim_operations as PywbemCimOperations
-  import pywbem.cim_http as PywbemCimHttp
-  import pywbem.exceptions as PywbemExceptions
-
-# Add a timeout for the script. When using with Nagios, the Nagios timeout cannot be < than plugin timeout.
-if on_windows == False and timeout > 0:
-  signal.signal(signal.SIGALRM, handler)
-  signal.alarm(timeout)
-
-# run the check for each defined class
-GlobalStatus = ExitUnknown
-server_info = ""
-bios_info = ""
-SerialNumber = ""
-ExitMsg = ""
-
-# if vendor is specified as 'auto', try to get vendor from CIM
-# note: the default vendor is 'unknown'
-if vendor=='auto':
+    f = open(hostlist, 'r')
+  hosts = []
+  for line in f:
+    fields = line.split()
+    if not fields or fields[0].startswith('#'):
+      continue
+    hostopts = copy.copy(opts)
+    set_host(hostopts, fields[0])
+    # monitoring objects are named case-sensitively, so passive results keep the name as written
+    hostopts.passive_host = fields[0]
+    if hostopts.passive_host.lower().startswith('https://'):
+      hostopts.passive_host = hostopts.passive_host[8:]
+    for field in fields[1:]:
+      key, sep, value = field.partition('=')
+      if not sep or key not in overrides:
+        raise ValueError("invalid entry '%s' for host %s" % (field, fields[0]))
+      setattr(hostopts, overrides[key], value)
+    hostopts.vendor = hostopts.vendor.lower()
+    hosts.append(hostopts)
+  if f is not sys.stdin:
+    f.close()
+  return hosts
+
+# ----------------------------------------------------------------------
+
+def new_check(opts, pool=None):
+  if opts.cimport:
+    verboseoutput("Using manually defined CIM port "+opts.cimport)
+    opts.hosturl += ':'+opts.cimport
+  return HostCheck(opts, pool)
+
+def check_hostopts(opts, pool=None):
+  # Run a full check for one host given by its options, returns (status, output, check)
+  check = new_check(opts, pool).run()
+  return check.GlobalStatus, check.output(), check
+
+# ----------------------------------------------------------------------
+
+class PassiveOutput:
+  # Submits the results of a host list as passive check results, --batch at a time:
+  # as PROCESS_SERVICE_CHECK_RESULT commands to the external command file of Nagios/Icinga
+  # (--command-file) or as Icinga2 API process-check-result requests, a JSON list per file,
+  # to a spool directory (--spool-dir) from where they are posted to the API.
+
+  def __init__(self, opts):
+    self.opts = opts
+    self.lock = threading.Lock()
+    self.pending = []
+    self.submitted = 0
+    self.error = None
+    self.fd = None
+    if opts.command_file:
+      self.fd = os.open(opts.command_file, os.O_WRONLY | os.O_APPEND)
+    elif not os.path.isdir(opts.spool_dir):
+      raise IOError("%s is not a directory" % opts.spool_dir)
+
+  def add(self, hostopts, status, text, perf):
+    with self.lock:
+      self.pending.append((int(time.time()), hostopts.passive_host, hostopts.service, status, text, perf))
+      if len(self.pending) >= self.opts.batch:
+        self.flush()
+
+  def close(self):
+    with self.lock:
+      self.flush()
+    if self.fd is not None:
+      os.close(self.fd)
+    verboseoutput("Submitted %d passive check results" % self.submitted)
+
+  def flush(self):
+    # called with the lock held
+    results, self.pending = self.pending, []
+    if not results or self.error:
+      return
+    try:
+      if self.fd is not None:
+        self.write_commands(results)
+      else:
+        self.write_spool(results)
+      self.submitted += len(results)
+    except (IOError, OSError) as e:
+      self.error = e
+
+  def write_commands(self, results):
+    # Writes to a pipe of up to PIPE_BUF bytes are not mixed with those of other processes,
+    # so the commands are written in chunks of whole lines below that size.
+    import select
+    limit = getattr(select, 'PIPE_BUF', 512)
+    chunk = b''
+    for now, host, service, status, text, perf in results:
+      output = plugin_output(text, perf).replace('\n', '\\n')
+      line = ("[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n" % (now, host, service, status, output)).encode('utf-8')
+      if chunk and len(chunk) + len(line) > limit:
+        os.write(self.fd, chunk)
+        chunk = b''
+      chunk += line
+    if chunk:
+      os.write(self.fd, chunk)
+
+  def write_spool(self, results):
+    # written to a temporary name first, so that the spool is never read half written
+    import json
+    requests = []
+    for now, host, service, status, text, perf in results:
+      requests.append({'type': 'Service', 'service': "%s!%s" % (host, service), 'exit_status': status,
+          'plugin_output': text, 'performance_data': perf.split(), 'execution_end': now})
+    name = "check_esxi_hardware-%d-%d-%d.json" % (results[0][0], os.getpid(), self.submitted)
+    path = os.path.join(self.opts.spool_dir, name)
+    tmppath = os.path.join(self.opts.spool_dir, '.' + name)
+    with open(tmppath, 'w') as f:
+      json.dump(requests, f)
+    os.replace(tmppath, path)
+
+# ----------------------------------------------------------------------
+
+def run_hostlist(opts):
+  # Check all hosts of the host list with a pool of worker threads and print one
+  # result per host as soon as it is available: "hostname;status;output" or a JSON object,
+  # or submit them as passive check results with --command-file or --spool-dir.
+  # Returns the exit code.
+  import concurrent.futures
   try:
-    c=wbemclient.EnumerateInstances('CIM_Chassis')
-  except PywbemCimOperations.CIMError as args:
-    if ( args[1].find('Socket error') >= 0 ):
-      print("UNKNOWN: {}".format(args))
-      sys.exit (ExitUnknown)
-    elif ( args[1].find('ThreadPool --- Failed to enqueue request') >= 0 ):
-      print("UNKNOWN: {}".format(args))
-      sys.exit (ExitUnknown)
+    hosts = read_hostlist(opts, opts.hostlist)
+  except (IOError, ValueError) as e:
+    print("UNKNOWN: Cannot read host list: %s" % e)
+    sys.exit(ExitUnknown)
+
+  passive = None
+  if opts.command_file or opts.spool_dir:
+    try:
+      passive = PassiveOutput(opts)
+    except (IOError, OSError) as e:
+      print("UNKNOWN: Cannot submit passive check results: %s" % e)
+      sys.exit(ExitUnknown)
+
+  printlock = threading.Lock()
+
+  def check_one(hostopts):
+    # signal.alarm cannot be used per host, so the timeout applies to each CIM request instead
+    if hostopts.timeout > 0:
+      hostopts.conn_timeout = hostopts.timeout
+    xdata = {}
+    perf = ''
+    if not hostopts.user or not hostopts.password:
+      status, text = ExitUnknown, "UNKNOWN: no user or password defined for this host"
     else:
-      verboseoutput("Unknown CIM Error: %s" % args)
-  except PywbemExceptions.ConnectionError as args:
-    GlobalStatus = ExitUnknown
-    print("UNKNOWN: {}".format(args))
-    sys.exit (GlobalStatus)
-  except PywbemExceptions.HTTPError as args:
-    GlobalStatus = ExitUnknown
-    print("UNKNOWN: {}".format(args))
-    sys.exit (GlobalStatus)
-  except PywbemCimHttp.AuthError as arg:
-    verboseoutput("Global exit set to UNKNOWN")
-    GlobalStatus = ExitUnknown
-    print("UNKNOWN: Authentication Error")
-    sys.exit (GlobalStatus)
+      try:
+        check = new_check(hostopts).run()
+        status, (text, perf), xdata = check.GlobalStatus, check.format(), check.xdata
+      except Exception as e:
+        status, text = ExitUnknown, "UNKNOWN: {}".format(e)
+    report(hostopts, status, text, perf, xdata)
+
+  def report(hostopts, status, text, perf, xdata):
+    if passive:
+      passive.add(hostopts, status, text, perf)
+      return
+    with printlock:
+      if opts.format == 'json':
+        if 'GlobalStatus' not in xdata:
+          xdata = {'GlobalStatus': status, 'Error': text}
+        xdata['Host'] = hostopts.hostname
+        print(xdataprint(hostopts, xdata))
+      elif opts.format in StreamFormats:
+        with RecordStream.lock:
+          print(stream_summary(hostopts, status, text))
+      else:
+        print("%s;%d;%s" % (hostopts.hostname, status, plugin_output(text, perf)))
+      sys.stdout.flush()
+
+  if opts.use_async:
+    run_hostlist_async(opts, hosts, report)
   else:
-    man=c[0][u'Manufacturer']
-    if re.match("Dell",man):
-      vendor="dell"
-    elif re.match("HP",man):
-      vendor="hp"
-    elif re.match("IBM",man):
-      vendor="ibm"
-    elif re.match("Intel",man):
-      vendor="intel"
+    with concurrent.futures.ThreadPoolExecutor(max_workers=opts.workers) as executor:
+      for hostopts in hosts:
+        executor.submit(check_one, hostopts)
+
+  if passive:
+    passive.close()
+    if passive.error:
+      print("UNKNOWN: Cannot submit passive check results: %s" % passive.error)
+      return ExitUnknown
+  return ExitOK
+
+def run_hostlist_async(opts, hosts, report):
+  # The host list checked by AsyncHostChecker, --workers limits the CIM requests in flight
+  # over all hosts and --parallel the ones per host
+  import asyncio
+  checker = AsyncHostChecker(opts.workers, opts.parallel)
+
+  async def check_one(hostopts):
+    if hostopts.timeout > 0:
+      hostopts.conn_timeout = hostopts.timeout
+    xdata = {}
+    perf = ''
+    if not hostopts.user or not hostopts.password:
+      status, text = ExitUnknown, "UNKNOWN: no user or password defined for this host"
     else:
-      vendor='unknown'
+      try:
+        check = await checker.run_check(hostopts)
+        status, (text, perf), xdata = check.GlobalStatus, check.format(), check.xdata
+      except Exception as e:
+        status, text = ExitUnknown, "UNKNOWN: {}".format(e)
+    report(hostopts, status, text, perf, xdata)
+
+  async def check_all():
+    await asyncio.gather(*(check_one(hostopts) for hostopts in hosts))
+
+  asyncio.run(check_all())
+  checker.executor.shutdown()
+
+# ----------------------------------------------------------------------
+
+# options which only concern the daemon or the client process and are not sent along with a request
+daemon_local_options = ['daemon', 'socket', 'interval', 'max_age', 'verbose', 'hostlist', 'workers', 'use_async', 'conn_timeout', 'sslproto',
+    'profile', 'profile_memory', 'profile_top', 'command_file', 'spool_dir', 'service', 'batch', 'exporter']
+
+def daemon_request_options(opts):
+  return dict((k, v) for k, v in vars(opts).items() if k not in daemon_local_options)
+
+# ----------------------------------------------------------------------
+
+class DaemonEntry:
+  # Last result of one host (with one set of options) known to the daemon
+  def __init__(self, opts):
+    self.opts = opts
+    self.lock = threading.Lock()
+    self.status = ExitUnknown
+    self.output = ""
+    self.checked = 0
+    self.requested = time.time()
+    # samples of each metric family with --exporter
+    self.metrics = {}
+
+# ----------------------------------------------------------------------
+
+class CheckDaemon:
+  # Serves check results over a UNIX socket. Every host which has been asked for is
+  # re-checked every 'interval' seconds in the background, using pooled connections,
+  # so that a request is usually answered from the last result without any CIM traffic.
+  # Hosts which are no longer asked for are forgotten after ten intervals.
+
+  def __init__(self, opts):
+    import concurrent.futures
+    self.opts = opts
+    self.pool = ConnectionPool()
+    self.entries = {}
+    self.lock = threading.Lock()
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=opts.workers)
+
+  def refresh(self, entry, blocking=True, max_age=None):
+    # A result another caller got while this one waited for the lock is kept if it is younger
+    # than max_age seconds, or of any age with None, so concurrent requests check a host once.
+    import copy
+    if not entry.lock.acquire(blocking):
+      return
+    try:
+      if entry.checked and (max_age is None or time.time() - entry.checked < max_age):
+        return
+      hostopts = copy.copy(entry.opts)
+      # signal.alarm cannot be used per host, so the timeout applies to each CIM request instead
+      if hostopts.timeout > 0:
+        hostopts.conn_timeout = hostopts.timeout
+      try:
+        entry.status, entry.output, check = check_hostopts(hostopts, self.pool)
+      except Exception as e:
+        entry.status, entry.output = ExitUnknown, "UNKNOWN: {}".format(e)
+      entry.checked = time.time()
+    finally:
+      entry.lock.release()
+
+  def request(self, request):
+    import copy
+    import json
+    reqopts = request['options']
+    key = json.dumps(reqopts, sort_keys=True)
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        hostopts = copy.copy(self.opts)
+        hostopts.__dict__.update(reqopts)
+        entry = self.entries[key] = DaemonEntry(hostopts)
+    entry.requested = time.time()
+    max_age = request.get('max_age', 0)
+    if not entry.checked or (max_age > 0 and time.time() - entry.checked > max_age):
+      verboseoutput("Checking %s on request" % entry.opts.hostname)
+      self.refresh(entry, max_age=max_age or None)
+    return {'status': entry.status, 'output': entry.output, 'age': time.time() - entry.checked}
+
+  def schedule(self):
+    while True:
+      time.sleep(1)
+      now = time.time()
+      with self.lock:
+        for key, entry in list(self.entries.items()):
+          if now - entry.requested > 10 * self.opts.interval:
+            verboseoutput("Forgetting %s" % entry.opts.hostname)
+            del self.entries[key]
+          elif entry.checked and now - entry.checked >= self.opts.interval and not entry.lock.locked():
+            verboseoutput("Scheduled check of %s" % entry.opts.hostname)
+            self.executor.submit(self.refresh, entry, False, self.opts.interval)
+
+  def serve(self):
+    import json
+    import signal
+    import socketserver
+    daemon = self
+
+    class Handler(socketserver.StreamRequestHandler):
+      def handle(self):
+        try:
+          answer = daemon.request(json.loads(self.rfile.readline().decode('utf-8')))
+        except Exception as e:
+          answer = {'status': ExitUnknown, 'output': "UNKNOWN: Invalid daemon request: {}".format(e)}
+        self.wfile.write((json.dumps(answer) + "\n").encode('utf-8'))
+
+    if os.path.exists(self.opts.socket):
+      os.remove(self.opts.socket)
+    server = socketserver.ThreadingUnixStreamServer(self.opts.socket, Handler)
+    server.daemon_threads = True
+    os.chmod(self.opts.socket, 0o600)
+    scheduler = threading.Thread(target=self.schedule)
+    scheduler.daemon = True
+    scheduler.start()
+    verboseoutput("Daemon listening on "+self.opts.socket)
+    # leave through the finally clause below on SIGTERM, so the socket gets removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(ExitOK))
+    try:
+      server.serve_forever()
+    finally:
+      os.remove(self.opts.socket)
+
+# ----------------------------------------------------------------------
 
-for classe in ClassesToCheck :
-  verboseoutput("Check classe "+classe)
+def query_daemon(opts):
+  # Ask a running daemon for the result of this check, returns (status, output)
+  # or None if no daemon answers on the socket
+  import json
+  import socket
+  request = {'options': daemon_request_options(opts), 'max_age': opts.max_age}
   try:
-    instance_list = wbemclient.EnumerateInstances(classe)
-  except PywbemCimOperations.CIMError as args:
-    if ( args[1].find('Socket error') >= 0 ):
-      print("UNKNOWN: {}".format(args))
-      sys.exit (ExitUnknown)
-    elif ( args[1].find('ThreadPool --- Failed to enqueue request') >= 0 ):
-      print("UNKNOWN: {}".format(args))
-      sys.exit (ExitUnknown)
-    else:
-      verboseoutput("Unknown CIM Error: %s" % args)
-  except PywbemExceptions.ConnectionError as args:
-    GlobalStatus = ExitUnknown
-    print("UNKNOWN: {}".format(args))
-    sys.exit (GlobalStatus)
-  except PywbemExceptions.HTTPError as args:
-    GlobalStatus = ExitUnknown
-    print("UNKNOWN: {}".format(args))
-    sys.exit (GlobalStatus)
-  except PywbemCimHttp.AuthError as arg:
-    verboseoutput("Global exit set to UNKNOWN")
-    GlobalStatus = ExitUnknown
-    print("UNKNOWN: Authentication Error")
-    sys.exit (GlobalStatus)
-  else:
-    # GlobalStatus = ExitOK #ARR
-    for instance in instance_list :
-      elementName = instance['ElementName']
-      if elementName is None :
-        elementName = 'Unknown'
-      elementNameValue = elementName
-      verboseoutput("  Element Name = "+elementName)
-
-      # Ignore element if we don't want it
-      if (regex == True) and (len(ignore_list) > 0) :
-        for ignore in ignore_list :
-          if re.search(ignore, elementName, re.IGNORECASE) :
-            verboseoutput("    (ignored through regex)")
-            regex_ignore_list.append(elementName)
-
-      if (elementName in ignore_list) or (elementName in regex_ignore_list) :
-        verboseoutput("    (ignored)")
-        continue
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(opts.socket)
+    s.sendall((json.dumps(request) + "\n").encode('utf-8'))
+    answer = s.makefile('rb').readline()
+    s.close()
+    answer = json.loads(answer.decode('utf-8'))
+  except (socket.error, ValueError) as e:
+    verboseoutput("No answer from daemon on %s: %s" % (opts.socket, e))
+    return None
+  verboseoutput("Daemon answered with a result of %ds age" % answer.get('age', 0))
+  return answer['status'], answer['output']
 
-      # BIOS & Server info
-      if elementName == 'System BIOS' :
-        bios_info =     instance[u'Name'] + ': ' \
-            + instance[u'VersionString'] + ' ' \
-            + str(instance[u'ReleaseDate'].datetime.date())
-        verboseoutput("    VersionString = "+instance[u'VersionString'])
-
-        xdata['Bios Info'] = bios_info
-
-      elif elementName == 'Chassis' :
-        man = instance[u'Manufacturer']
-        if man is None :
-          man = 'Unknown Manufacturer'
-        verboseoutput("    Manufacturer = "+man)
-        SerialNumber = instance[u'SerialNumber']
-        SerialChassis = instance[u'SerialNumber']
-        if SerialNumber:
-          verboseoutput("    SerialNumber = "+SerialNumber)
-        server_info = man + ' '
-        if vendor != 'intel':
-          model = instance[u'Model']
-          if model:
-            verboseoutput("    Model = "+model)
-            server_info +=  model
-
-      elif elementName == 'Server Blade' :
-        SerialNumber = instance[u'SerialNumber']
-        if SerialNumber:
-          verboseoutput("    SerialNumber = "+SerialNumber)
-          isblade = "yes"
-
-      xdata['SerialNumber'] = SerialNumber
-
-      # Report detail of Numeric Sensors and generate nagios perfdata
-
-      if classe == "CIM_NumericSensor" :
-        sensorType = instance[u'sensorType']
-        sensStr = sensor_Type.get(sensorType,"Unknown")
-        if sensorType:
-          verboseoutput("    sensorType = %d - %s" % (sensorType,sensStr))
-        units = instance[u'BaseUnits']
-        if units:
-          verboseoutput("    BaseUnits = %d" % units)
-        # grab some of these values for Nagios performance data
-        scale = 10**instance[u'UnitModifier']
-        verboseoutput("    Scaled by = %f " % scale)
-        cr = int(instance[u'CurrentReading'])*scale
-        verboseoutput("    Current Reading = %f" % cr)
-        elementNameValue = "%s: %g" % (elementName,cr)
-        ltnc = 0
-        utnc = 0
-        ltc  = 0
-        utc  = 0
-        if instance[u'LowerThresholdNonCritical'] is not None:
-          ltnc = instance[u'LowerThresholdNonCritical']*scale
-          verboseoutput("    Lower Threshold Non Critical = %f" % ltnc)
-        if instance[u'UpperThresholdNonCritical'] is not None:
-          utnc = instance[u'UpperThresholdNonCritical']*scale
-          verboseoutput("    Upper Threshold Non Critical = %f" % utnc)
-        if instance[u'LowerThresholdCritical'] is not None:
-          ltc = instance[u'LowerThresholdCritical']*scale
-          verboseoutput("    Lower Threshold Critical = %f" % ltc)
-        if instance[u'UpperThresholdCritical'] is not None:
-          utc = instance[u'UpperThresholdCritical']*scale
-          verboseoutput("    Upper Threshold Critical = %f" % utc)
-        #
-        if perfdata:
-          perf_el = elementName.replace(' ','_')
-
-          # Power and Current
-          if sensorType == 4:               # Current or Power Consumption
-            if units == 7:            # Watts
-              if get_power:
-                data.append( ("%s=%g;%g;%g " % (perf_el, cr, utnc, utc),1) )
-                xdata[perf_el] = { 'Unit': 'Watt', 'Value': cr, 'warn' : utnc, 'crit': utc }
-            elif units == 6:          # Current
-              if get_current:
-                data.append( ("%s=%g;%g;%g " % (perf_el, cr, utnc, utc),3) )
-                xdata[perf_el] = { 'Unit': 'Ampere', 'Value': cr, 'warn' : utnc, 'crit': utc }
-
-          # PSU Voltage
-          elif sensorType == 3:               # Voltage
-            if get_volts:
-              data.append( ("%s=%g;%g;%g " % (perf_el, cr, utnc, utc),2) )
-              xdata[perf_el] = { 'Unit': 'Volt', 'Value': cr, 'warn' : utnc, 'crit': utc }
-
-          # Temperatures
-          elif sensorType == 2:               # Temperature
-            if get_temp:
-              data.append( ("%s=%g;%g;%g " % (perf_el, cr, utnc, utc),4) )
-              xdata[perf_el] = { 'Value': cr, 'warn' : utnc, 'crit': utc }
-
-          # Fan speeds
-          elif sensorType == 5:               # Tachometer
-            if get_fan:
-              if units == 65:                 # percentage
-                data.append( ("%s=%g%%;%g;%g " % (perf_el, cr, utnc, utc),6) )
-                xdata[perf_el] = { 'Unit': '%', 'Value': cr, 'warn' : utnc, 'crit': utc }
-              else:
-                data.append( ("%s=%g;%g;%g " % (perf_el, cr, utnc, utc),5) )
-                xdata[perf_el] = { 'Value': cr, 'warn' : utnc, 'crit': utc }
-
-      elif classe == "CIM_Processor" :
-        verboseoutput("    Family = %d" % instance['Family'])
-        verboseoutput("    CurrentClockSpeed = %dMHz" % instance['CurrentClockSpeed'])
-
-      # HP Check
-      if vendor == "hp" :
-        if instance['HealthState'] is not None :
-          elementStatus = instance['HealthState']
-          verboseoutput("    Element HealthState = %d" % elementStatus)
-          interpretStatus = {
-            0  : ExitOK,    # Unknown
-            5  : ExitOK,    # OK
-            10 : ExitWarning,  # Degraded
-            15 : ExitWarning,  # Minor
-            20 : ExitCritical,  # Major
-            25 : ExitCritical,  # Critical
-            30 : ExitCritical,  # Non-recoverable Error
-          }[elementStatus]
-          if (interpretStatus == ExitCritical) :
-            verboseoutput("Global exit set to CRITICAL")
-            GlobalStatus = ExitCritical
-            ExitMsg += " CRITICAL : %s " % elementNameValue
-          if (interpretStatus == ExitWarning and GlobalStatus != ExitCritical) :
-            verboseoutput("Global exit set to WARNING")
-            GlobalStatus = ExitWarning
-            ExitMsg += " WARNING : %s " % elementNameValue
-          # Added the following for when GlobalStatus is ExitCritical and a warning is detected
-          # This way the ExitMsg gets added but GlobalStatus isn't changed
-          if (interpretStatus == ExitWarning and GlobalStatus == ExitCritical) : # ARR
-            ExitMsg += " WARNING : %s " % elementNameValue #ARR
-          # Added the following so that GlobalStatus gets set to OK if there's no warning or critical
-          if (interpretStatus == ExitOK and GlobalStatus != ExitWarning and GlobalStatus != ExitCritical) : #ARR
-            GlobalStatus = ExitOK #ARR
-
-
-
-      # Dell, Intel, IBM and unknown hardware check
-      elif (vendor == "dell" or vendor == "intel" or vendor == "ibm" or vendor=="unknown") :
-        # Added 20121027 As long as Dell doesnt correct these CIM elements return code we have to ignore it
-        ignore_list.append("System Board 1 Riser Config Err 0: Connected")
-        ignore_list.append("Add-in Card 4 PEM Presence 0: Connected")
-        if instance['OperationalStatus'] is not None :
-          elementStatus = instance['OperationalStatus'][0]
-          verboseoutput("    Element Op Status = %d" % elementStatus)
-          interpretStatus = {
-            0  : ExitOK,            # Unknown
-            1  : ExitCritical,      # Other
-            2  : ExitOK,            # OK
-            3  : ExitWarning,       # Degraded
-            4  : ExitWarning,       # Stressed
-            5  : ExitWarning,       # Predictive Failure
-            6  : ExitCritical,      # Error
-            7  : ExitCritical,      # Non-Recoverable Error
-            8  : ExitWarning,       # Starting
-            9  : ExitWarning,       # Stopping
-            10 : ExitCritical,      # Stopped
-            11 : ExitOK,            # In Service
-            12 : ExitWarning,       # No Contact
-            13 : ExitCritical,      # Lost Communication
-            14 : ExitCritical,      # Aborted
-            15 : ExitOK,            # Dormant
-            16 : ExitCritical,      # Supporting Entity in Error
-            17 : ExitOK,            # Completed
-            18 : ExitOK,            # Power Mode
-            19 : ExitOK,            # DMTF Reserved
-            20 : ExitOK             # Vendor Reserved
-          }[elementStatus]
-          if (interpretStatus == ExitCritical) :
-            verboseoutput("Global exit set to CRITICAL")
-            GlobalStatus = ExitCritical
-            ExitMsg += " CRITICAL : %s " % elementNameValue
-          if (interpretStatus == ExitWarning and GlobalStatus != ExitCritical) :
-            verboseoutput("Global exit set to WARNING")
-            GlobalStatus = ExitWarning
-            ExitMsg += " WARNING : %s " % elementNameValue
-          # Added same logic as in 20100702 here, otherwise Dell servers would return UNKNOWN instead of OK
-          if (interpretStatus == ExitWarning and GlobalStatus == ExitCritical) : # ARR
-            ExitMsg += " WARNING : %s " % elementNameValue #ARR
-          if (interpretStatus == ExitOK and GlobalStatus != ExitWarning and GlobalStatus != ExitCritical) : #ARR
-            GlobalStatus = ExitOK #ARR
-        if elementName == 'Server Blade' :
-                if SerialNumber :
-                        if SerialNumber.find(".") != -1 :
-                                SerialNumber = SerialNumber.split('.')[1]
-
-
-# Munge the ouptput to give links to documentation and warranty info
-if (urlise_country != '') :
-  SerialNumber = urlised_serialnumber(vendor,urlise_country,SerialNumber)
-  server_info = urlised_server_info(vendor,urlise_country,server_info)
-
-# If this is a blade server, also output chassis serial number as additional info
-if (isblade == "yes") :
-  SerialNumber += " Chassis S/N: %s " % (SerialChassis)
-  xdata['ChassisSerialNumber'] = SerialChassis
-
-# Output performance data
-perf = '|'
-if perfdata:
-  sdata=[]
-  ctr=[0,0,0,0,0,0,0]
-  # sort the data so we always get perfdata in the right order
-  # we make no assumptions about the order in which CIM returns data
-  # first sort by element name (effectively) and insert sequence numbers
-  for p in sorted(data):
-    p1 = p[1]
-    sdata.append( ("P%d%s_%d_%s") % (p1,perf_Prefix[p1], ctr[p1], p[0]) )
-    ctr[p1] += 1
-  # then sort perfdata into groups and output perfdata string
-  for p in sorted(sdata):
-    perf += p
-
-# sanitise perfdata - don't output "|" if nothing to report
-if perf == '|':
-  perf = ''
-
-# Cleanup temporary openssl config
-if sslproto:
-  os.remove(sslconfpath)
-
-xdata['GlobalStatus'] = GlobalStatus
-
-if GlobalStatus == ExitOK :
-  if format == 'string':
-    print("OK - Server: %s s/n: %s %s%s" % (server_info, SerialNumber, bios_info, perf))
-  else:
-    xdataprint()
+# ----------------------------------------------------------------------
+
+# metric families served by the exporter, in this order
+ExporterMetrics = [
+  ('esxi_up', "1 if the last check of the host was completed, else 0"),
+  ('esxi_check_status', "status of the last check: 0 OK, 1 WARNING, 2 CRITICAL, 3 UNKNOWN"),
+  ('esxi_check_timestamp_seconds', "time the last check finished"),
+  ('esxi_check_duration_seconds', "duration of the last check"),
+  ('esxi_sensor_value', "reading of a numeric sensor, scaled by its UnitModifier"),
+  ('esxi_sensor_threshold', "threshold of a numeric sensor, the ones not set are left out"),
+  ('esxi_element_status', "status of an element: 0 OK, 1 WARNING, 2 CRITICAL"),
+]
+
+def metric_labels(**labels):
+  return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+      for k, v in labels.items())
+
+def host_metrics(hostname, check, status, duration):
+  # Returns the samples of the last check of a host, a list per metric family.
+  # check is None if the check raised an exception.
+  metrics = dict((name, []) for name, description in ExporterMetrics)
+  host = metric_labels(host=hostname)
+  up = 1 if check is not None and not check.failure else 0
+  metrics['esxi_up'].append("esxi_up{%s} %d" % (host, up))
+  metrics['esxi_check_status'].append("esxi_check_status{%s} %d" % (host, status))
+  metrics['esxi_check_timestamp_seconds'].append("esxi_check_timestamp_seconds{%s} %.3f" % (host, time.time()))
+  metrics['esxi_check_duration_seconds'].append("esxi_check_duration_seconds{%s} %.3f" % (host, duration))
+  if not up:
+    return metrics
+  for sensor in check.sensors:
+    labels = metric_labels(host=hostname, sensor=sensor.name, type=sensor_Type.get(sensor.sensor_type, "Unknown"),
+        unit=sensor_Units.get(sensor.units, "unknown"))
+    metrics['esxi_sensor_value'].append("esxi_sensor_value{%s} %r" % (labels, float(sensor.value)))
+    for threshold in ('lower_warn', 'upper_warn', 'lower_crit', 'upper_crit'):
+      value = getattr(sensor, threshold)
+      if value:
+        metrics['esxi_sensor_threshold'].append("esxi_sensor_threshold{%s,threshold=\"%s\"} %r" % (labels, threshold, float(value)))
+  for element, elementStatus in sorted(check.elements.items()):
+    labels = metric_labels(host=hostname, element=element, **{'class': check.element_classes.get(element, 'unknown')})
+    metrics['esxi_element_status'].append("esxi_element_status{%s} %d" % (labels, elementStatus))
+  return metrics
+
+class MetricsExporter:
+  # Serves the sensor readings and element states of the hosts of --hostlist as Prometheus
+  # metrics over HTTP. Every host is checked every --interval seconds in the background with
+  # pooled connections, a scrape only joins the samples of the last checks and never waits
+  # for a CIM request.
+
+  def __init__(self, opts):
+    import concurrent.futures
+    self.opts = opts
+    try:
+      hosts = read_hostlist(opts, opts.hostlist)
+    except (IOError, ValueError) as e:
+      print("UNKNOWN: Cannot read host list: %s" % e)
+      sys.exit(ExitUnknown)
+    self.pool = ConnectionPool()
+    self.entries = [DaemonEntry(hostopts) for hostopts in hosts]
+    # entries submitted to the executor and not checked yet
+    self.pending = set()
+    self.lock = threading.Lock()
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=opts.workers)
+
+  def refresh(self, entry):
+    import copy
+    entry.lock.acquire()
+    try:
+      hostopts = copy.copy(entry.opts)
+      # signal.alarm cannot be used per host, so the timeout applies to each CIM request instead
+      if hostopts.timeout > 0:
+        hostopts.conn_timeout = hostopts.timeout
+      start = time.time()
+      check = None
+      if not hostopts.user or not hostopts.password:
+        entry.status, entry.output = ExitUnknown, "UNKNOWN: no user or password defined for this host"
+      else:
+        try:
+          entry.status, entry.output, check = check_hostopts(hostopts, self.pool)
+        except Exception as e:
+          entry.status, entry.output = ExitUnknown, "UNKNOWN: {}".format(e)
+      verboseoutput("Checked %s: %s" % (entry.opts.hostname, entry.output))
+      entry.metrics = host_metrics(entry.opts.hostname, check, entry.status, time.time() - start)
+      entry.checked = time.time()
+    finally:
+      entry.lock.release()
+      with self.lock:
+        self.pending.discard(entry)
+
+  def schedule(self):
+    while True:
+      now = time.time()
+      with self.lock:
+        for entry in self.entries:
+          if now - entry.checked >= self.opts.interval and entry not in self.pending:
+            self.pending.add(entry)
+            self.executor.submit(self.refresh, entry)
+      time.sleep(1)
+
+  def scrape(self):
+    lines = []
+    for name, description in ExporterMetrics:
+      lines.append("# HELP %s %s" % (name, description))
+      lines.append("# TYPE %s gauge" % name)
+      for entry in self.entries:
+        lines.extend(entry.metrics.get(name, ()))
+    return "\n".join(lines) + "\n"
+
+  def serve(self):
+    import http.server
+    import signal
+    exporter = self
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+          self.send_error(404)
+          return
+        body = exporter.scrape().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        verboseoutput("Exporter: " + format % args)
+
+    addr, sep, port = self.opts.exporter.rpartition(':')
+    try:
+      server = http.server.ThreadingHTTPServer((addr, int(port)), Handler)
+    except (ValueError, OSError) as e:
+      print("UNKNOWN: Cannot listen on %s: %s" % (self.opts.exporter, e))
+      sys.exit(ExitUnknown)
+    server.daemon_threads = True
+    scheduler = threading.Thread(target=self.schedule)
+    scheduler.daemon = True
+    scheduler.start()
+    verboseoutput("Exporter listening on "+self.opts.exporter)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(ExitOK))
+    server.serve_forever()
+
+# ----------------------------------------------------------------------
 
-elif GlobalStatus == ExitUnknown :
-  if format == 'string':
-    print("UNKNOWN: %s" % (ExitMsg)) #ARR
+# pywbem takes most of the startup time, it is imported by the first HostCheck only,
+# so that --help, wrong options and answers from a daemon do without it
+pywbem = None
+
+def import_pywbem():
+  global pywbem, PywbemCimOperations, PywbemCimHttp, PywbemExceptions
+  if pywbem is not None:
+    return
+  import pywbem
+  verboseoutput("Found pywbem version "+pywbem.__version__)
+
+  # Backward compatibility for older pywbem exceptions, big thanks to Claire M.!
+  # pywbem 1.0.0 made its modules private, which tells the versions apart without 'packaging'
+  if hasattr(pywbem, '_cim_operations'):
+    verboseoutput("pywbem is 1.0.0 or newer")
+    import pywbem._cim_operations as PywbemCimOperations
+    import pywbem._cim_http as PywbemCimHttp
+    import pywbem._exceptions as PywbemExceptions
   else:
-    xdataprint()
+    verboseoutput("pywbem is older than 1.0.0")
+    import pywbem.cim_operations as PywbemCimOperations
+    import pywbem.cim_http as PywbemCimHttp
+    import pywbem.exceptions as PywbemExceptions
+
+# ----------------------------------------------------------------------
+
+def main():
+  # The command line plugin, the check itself is done by check_hostopts() as for library callers
+  options = getopts()
+
+  # if running on Windows, don't use timeouts and signal.alarm
+  on_windows = True
+  os_platform = sys.platform
+  if os_platform != "win32":
+    on_windows = False
+    import signal
+    def handler(signum, frame):
+      print('UNKNOWN: Execution time too long!')
+      sys.exit(ExitUnknown)
+
+  # Use non-default SSL protocol version
+  sslproto = options.sslproto
+  if sslproto:
+    verboseoutput("Using non-default SSL protocol: "+sslproto)
+    allowed_protos = ["SSLv2", "SSLv3", "TLSv1", "TLSv1.1", "TLSv1.2", "TLSv1.3"]
+    if any(proto.lower() == sslproto.lower() for proto in allowed_protos):
+      sslconfpath = '/tmp/'+options.hostname+'_openssl.conf'
+      verboseoutput("Creating OpenSSL config file: "+sslconfpath)
+      try:
+        with open(sslconfpath, 'w') as config_file:
+            config_file.write("openssl_conf = openssl_init\n[openssl_init]\nssl_conf = ssl_configuration\n[ssl_configuration]\nsystem_default = tls_system_default\n[tls_system_default]\nMinProtocol = "+sslproto+"\n")
+      except Exception as e:
+        print('CRITICAL: An error occured while trying to write ssl config file: %s (%s)' % (sslconfpath, e))
+        sys.exit(ExitCritical)
+      os.environ["OPENSSL_CONF"] = sslconfpath
+    else:
+      print('CRITICAL: Invalid SSL protocol version given!')
+      sys.exit(ExitCritical)
 
-else:
-  if format == 'string':
-    print("%s - Server:  %s %s %s%s" % (ExitMsg, server_info, 's/n: ' + SerialNumber, bios_info, perf))
+  if options.daemon:
+    if on_windows:
+      print('UNKNOWN: Daemon mode is not available on Windows')
+      sys.exit(ExitUnknown)
+    CheckDaemon(options).serve()
+
+  if options.exporter:
+    if on_windows:
+      print('UNKNOWN: Exporter mode is not available on Windows')
+      sys.exit(ExitUnknown)
+    MetricsExporter(options).serve()
+
+  if options.hostlist:
+    status = run_hostlist(options)
+    if sslproto:
+      os.remove(sslconfpath)
+    sys.exit(status)
+
+  # Add a timeout for the script. When using with Nagios, the Nagios timeout cannot be < than plugin timeout.
+  if on_windows == False and options.timeout > 0:
+    signal.signal(signal.SIGALRM, handler)
+    signal.alarm(options.timeout)
+
+  answer = None
+  # the daemon returns the output only, not the records written while the check runs
+  if options.socket and not on_windows and options.format not in StreamFormats:
+    answer = query_daemon(options)
+  if answer:
+    GlobalStatus, output = answer
   else:
-    xdataprint()
+    GlobalStatus, output, check = check_hostopts(options)
+
+  # Cleanup temporary openssl config
+  if sslproto:
+    os.remove(sslconfpath)
+
+  print(output)
+  sys.exit (GlobalStatus)
+
+# ----------------------------------------------------------------------
 
-sys.exit (GlobalStatus)
+def profile_options(argv):
+  # Returns the options if --profile was given, they are looked at before getopts()
+  # so that it can be part of the profile too. Errors are left to getopts().
+  import io
+  parser = option_parser()
+  parser.error = lambda message: None
+  stdout, stderr = sys.stdout, sys.stderr
+  sys.stdout = sys.stderr = io.StringIO()
+  try:
+    (opts, args) = parser.parse_args(argv)
+  except SystemExit:
+    # --help or --version, printed by getopts() then
+    return None
+  finally:
+    sys.stdout, sys.stderr = stdout, stderr
+  if not opts.profile:
+    return None
+  return opts
+
+def run_profiled(opts):
+  # Run main() under cProfile, and tracemalloc with --profile-memory, until it exits.
+  # The profile is written to the --profile file (read it with python3 -m pstats FILE),
+  # the biggest memory allocations to FILE.memory. With --verbose a summary is printed.
+  import cProfile
+  import pstats
+  import tracemalloc
+  if opts.profile_memory:
+    tracemalloc.start(25)
+  profiler = cProfile.Profile()
+  try:
+    profiler.runcall(main)
+  finally:
+    profiler.disable()
+    profiler.dump_stats(opts.profile)
+    if verbose:
+      print("Profile written to %s, top %d functions by cumulative time:" % (opts.profile, opts.profile_top))
+      pstats.Stats(profiler, stream=sys.stdout).sort_stats('cumulative').print_stats(opts.profile_top)
+    if opts.profile_memory:
+      snapshot = tracemalloc.take_snapshot()
+      current, peak = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+      with open(opts.profile + '.memory', 'w') as f:
+        f.write("peak %d bytes, %d bytes still allocated at exit\n" % (peak, current))
+        for stat in snapshot.statistics('lineno')[:100]:
+          f.write("%s\n" % stat)
+      if verbose:
+        print("Peak memory %d KiB, top %d allocations (all in %s.memory):" % (peak / 1024, opts.profile_top, opts.profile))
+        for stat in snapshot.statistics('lineno')[:opts.profile_top]:
+          print(stat)
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+  profile = profile_options(sys.argv[1:])
+  if profile:
+    run_profiled(profile)
+  else:
+    main()